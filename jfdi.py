@@ -13,6 +13,13 @@
 # - handle OSError could not rmdir because a dos prompt is in it
 
 _cfg = {'verbose': False,
+        'jobs': 1,
+        'always': False,
+        'state_dir': '.jfdi',
+        'cache_dir': None,
+        'cache_size': 0,
+        'dir_cache': False,
+        'unity': 0,
         'build_vars': {} }
 
 import sys
@@ -22,26 +29,26 @@ if sys.version_info[0] < 3:
     sys.stderr.write('https://github.com/mlabbe/jfdi')
     sys.exit(1)
 
+# modules that are slow to import are imported by the functions that
+# use them, so trivial invocations like --version start quickly.
 import os
 import sys
-import glob
 import time
-import shutil
+import _thread
+import marshal
 import os.path
-import argparse
-import platform
-import subprocess
 
 VERSION=(1,1)
 
 g_start_time = time.time()
+g_start_perf = time.perf_counter()
 
 def _is_jfdi_compatible_with_build_script_version():
     """is this version of jfdi.py compatible with the build format version?
     The value is stored in JFDI_VERSION in the generated template.
 
     None return value means it's compatible"""
-    script_version = int(globals()['JFDI_VERSION'])
+    script_version = int(_ns()['JFDI_VERSION'])
     
     if script_version == 1:
         return None
@@ -63,6 +70,7 @@ class _ArgDispatch:
     jfdi [args, options]
     """
     def dispatch(self):
+        import argparse
         desc = "JFDI Simple Build System version %s" % (_pp_version())
         p = argparse.ArgumentParser(
             description=desc,
@@ -74,6 +82,8 @@ The most commonly used jfdi subcommands are:
     {jfdi} build   # build your project
     {jfdi} clean   # clean your project
     {jfdi} run     # run your built project
+    {jfdi} watch   # build, then rebuild as files change
+    {jfdi} server  # keep the build script loaded for faster builds
 
 More help topics:
 
@@ -118,6 +128,16 @@ More help topics:
         global _cfg
         _cfg['verbose'] = sub_args.verbose
         _cfg['build_vars'] = build_vars
+        if getattr(sub_args, 'trace', None) != None:
+            _start_trace(sub_args.trace)
+        if getattr(sub_args, 'jobs', None) != None:
+            _cfg['jobs'] = sub_args.jobs
+        _cfg['always'] = getattr(sub_args, 'always_make', False)
+        if getattr(sub_args, 'cache_dir', None):
+            _cfg['cache_dir'] = sub_args.cache_dir
+            _cfg['cache_size'] = _parse_size(sub_args.cache_size)
+        _cfg['dir_cache'] = getattr(sub_args, 'dir_cache', False)
+        _cfg['unity'] = getattr(sub_args, 'unity', 0)
         
         return (top_args.subcommand, sub_args, build_vars)
 
@@ -139,7 +159,12 @@ More help topics:
 
         p.add_argument('--target-os',
                        help='specify TARGET_OS for cross compiling',
-                       default=platform.system())
+                       default=_host_os())
+
+        p.add_argument('--trace',
+                       help='write a Chrome trace-event timeline of the ' +
+                       'build to FILE, viewable in Perfetto',
+                       metavar='FILE')
         
         return p
         
@@ -175,6 +200,7 @@ More help topics:
         
 
     def subcommand_init(self):
+        import argparse
         p = argparse.ArgumentParser(
             description='init creates a new build.jfdi in the working directory',
             prog=self._subcommand_prog('init'),
@@ -188,6 +214,7 @@ More help topics:
         
 
     def subcommand_clean(self): 
+        import argparse
        
         p = argparse.ArgumentParser(
             description='clean intermediate and build product files by calling clean() in build.jfdi',
@@ -196,6 +223,8 @@ More help topics:
 
         p = self._add_common_args(p)
         
+        p = self._add_variants_arg(p)
+        
         sub_args, unknown_args = p.parse_known_args(sys.argv[2:])
         build_vars = self._parse_build_vars(unknown_args)
 
@@ -203,6 +232,7 @@ More help topics:
 
     
     def subcommand_build(self):
+        import argparse
 
         p = argparse.ArgumentParser(
             description="build the program by executing build.jfdi",
@@ -215,6 +245,8 @@ More help topics:
                        action='store_true')
         p.add_argument('--version', help='print version and exit',
                        action='store_true')
+        p = self._add_job_args(p)
+        p = self._add_variants_arg(p)
 
         # work around implicit build subcommand
         first_arg = 2
@@ -226,8 +258,127 @@ More help topics:
 
         return sub_args, build_vars
 
+    @staticmethod
+    def _add_variants_arg(p):
+        p.add_argument('--variants',
+                       help='build each comma-separated buildvar setting ' +
+                       'as its own variant in one run, ie: DEBUG=0,DEBUG=1.  ' +
+                       'repeat to build every combination, ie: ' +
+                       '--variants TARGET_OS=Linux,TARGET_OS=Windows',
+                       metavar='VAR=VALUE,...', action='append')
+        return p
+
+    @staticmethod
+    def _parse_variants(specs, build_vars, target_os):
+        """expand --variants into a list of (label, target os, build vars)
+        tuples, one per combination.  TARGET_OS=value sets the variant's
+        TARGET_OS, anything else is a buildvar."""
+        variants = [([], target_os, build_vars)]
+        keys = set(build_vars)
+        for spec in specs:
+            choices = []
+            for v in spec.split(','):
+                var = v.split('=', 1)
+                if len(var) == 1 or len(var[1]) == 0:
+                    _fatal_error('"%s": variant must be buildvar=value\n' % v)
+                choices.append((var[0].upper(), var[1]))
+
+            for ukey in set(c[0] for c in choices):
+                if ukey in keys:
+                    _fatal_error('"%s": buildvar specified multiple times\n' %
+                                 ukey)
+                keys.add(ukey)
+
+            expanded = []
+            for labels, variant_os, variant_vars in variants:
+                for ukey, value in choices:
+                    label = labels + ['%s=%s' % (ukey, value)]
+                    if ukey == 'TARGET_OS':
+                        expanded.append((label, value, variant_vars))
+                    else:
+                        expanded.append((label, variant_os,
+                                         dict(variant_vars, **{ukey: value})))
+            variants = expanded
+
+        return [(' '.join(labels), variant_os, variant_vars)
+                for labels, variant_os, variant_vars in variants]
+
+    @staticmethod
+    def _add_job_args(p):
+        """add args that control how build_this() jobs run"""
+        p.add_argument('-j', '--jobs',
+                       help='run N build_this() commands at once ' +
+                       '(default: number of cpus)',
+                       metavar='N', type=int,
+                       default=os.cpu_count() or 1)
+        p.add_argument('-B', '--always-make',
+                       help='run every job() even if its outputs are up to date',
+                       action='store_true')
+        p.add_argument('--cache-dir',
+                       help='cache compiled objects in DIR ' +
+                       '(default: $JFDI_CACHE_DIR)',
+                       metavar='DIR',
+                       default=os.environ.get('JFDI_CACHE_DIR'))
+        p.add_argument('--cache-size',
+                       help='evict least recently used objects when the ' +
+                       'cache exceeds SIZE, ie: 500M, 5G ' +
+                       '(default: $JFDI_CACHE_SIZE or 5G)',
+                       metavar='SIZE',
+                       default=os.environ.get('JFDI_CACHE_SIZE', '5G'))
+        p.add_argument('--dir-cache',
+                       help='remember directory listings in .jfdi/ and only ' +
+                       'rescan directories whose mtime changed when ' +
+                       'expanding wildcards',
+                       action='store_true')
+        p.add_argument('--unity',
+                       help='compile C and C++ input files as N unity ' +
+                       'sources, each #including a batch of them',
+                       metavar='N', type=int, default=0)
+        return p
+
+    def subcommand_watch(self):
+        import argparse
+
+        p = argparse.ArgumentParser(
+            description="build, then rebuild input files as they change",
+            prog=self._subcommand_prog('watch'),
+        )
+
+        p = self._add_common_args(p)
+        p = self._add_job_args(p)
+
+        p.add_argument('--debounce',
+                       help='wait until files stop changing for MS ' +
+                       'milliseconds before rebuilding (default: 200)',
+                       metavar='MS', type=int, default=200)
+        p.add_argument('--poll',
+                       help='poll for changes instead of using inotify',
+                       action='store_true')
+
+        sub_args, unknown_args = p.parse_known_args(sys.argv[2:])
+        build_vars = self._parse_build_vars(unknown_args)
+
+        return sub_args, build_vars
+
     
+    def subcommand_server(self):
+        import argparse
+
+        p = argparse.ArgumentParser(
+            description="serve builds from a warm process.  while it " +
+            "runs, jfdi commands for the same build.jfdi are forwarded to " +
+            "it.  set JFDI_NO_SERVER=1 to bypass it",
+            prog=self._subcommand_prog('server'),
+        )
+
+        p = self._add_common_args(p)
+
+        sub_args = p.parse_args(sys.argv[2:])
+
+        return sub_args, {} # build vars come with each request
+
     def subcommand_run(self):
+        import argparse
 
         p = argparse.ArgumentParser(
             description="perform a canonical run of the program by calling run() in build.jfdi",
@@ -243,6 +394,7 @@ More help topics:
 
     
     def subcommand_help(self):
+        import argparse
 
         p = argparse.ArgumentParser(
             description="additional help topics",
@@ -265,17 +417,33 @@ def _which(file):
             return os.path.join(path, file)
     return None
 
+def _host_os():
+    """platform.system() without the cost of importing platform"""
+    if sys.platform == 'win32':
+        return 'Windows'
+    if hasattr(os, 'uname'):
+        return os.uname().sysname
+
+    import platform
+    return platform.system()
+
 def _pp_version():
     """pretty print version as a string"""
     return '.'.join(str(i) for i in VERSION)
 
 def _clean(context, target_os):
-    globals()['TARGET_OS'] = target_os
+    context[0]['TARGET_OS'] = target_os
     _message(1, "cleaning")
-    input_files = context[0]['list_input_files']()
-    input_files = _handle_input_files(input_files)
+    with _TraceSpan('list_input_files'):
+        input_files = context[0]['list_input_files']()
+        input_files = _handle_input_files(input_files)
+
+    # obj() names the objects of the last --unity build
+    _unity_load_members()
     
-    context[0]['clean'](input_files)
+    with _TraceSpan('clean'):
+        context[0]['clean'](input_files)
+    _api_wait_all()
     # returning from clean means the calling script did not die(), and so
     # it was a success.
     
@@ -291,10 +459,18 @@ def _message(verbosity, in_msg):
         
     if verbosity >= 1 and not _cfg['verbose']:
         return
-    print("%s %s" % (_log_stamp(), msg))
+    _write_line(sys.stdout, "%s %s\n" % (_log_stamp(), msg))
 
 def _warning(msg):
-    sys.stderr.write("%s WARNING: %s" % (_log_stamp(), msg))
+    _write_line(sys.stderr, "%s WARNING: %s" % (_log_stamp(), msg))
+
+# job workers log too.  print() writes the text and the newline
+# separately, so their lines could run together.
+_output_lock = _thread.allocate_lock()
+
+def _write_line(f, line):
+    with _output_lock:
+        f.write(line)
 
 def _fatal_error(msg, error_code=1):
     sys.stderr.write(_log_stamp() + ' FATAL: ')
@@ -327,19 +503,69 @@ def _get_script(args_file):
                      % sys.argv[0]
         _fatal_error(fatal_msg)
 
-    with open(script_path) as f:
+    # build state (build log, etc.) lives next to the build script
+    _cfg['state_dir'] = os.path.join(os.path.dirname(script_path), '.jfdi')
+
+    with open(script_path, 'rb') as f:
         script = f.read()
 
+    cache_path = os.path.join(_cfg['state_dir'],
+                              os.path.basename(script_path) + '.pyc')
+    cache_key = _script_cache_key(script_path, script)
+
+    # compiled earlier by this process, eg. a build server
+    pycode = _script_memo.get(cache_key)
+    if pycode != None:
+        return pycode
+
+    pycode = _load_script_cache(cache_path, cache_key)
+    if pycode != None:
+        _message(1, "script cache hit for %s" % script_path)
+        _script_memo[cache_key] = pycode
+        return pycode
+
+    _message(1, "script cache miss for %s; compiling" % script_path)
     try:
-        pycode = compile(script, script_path, mode='exec')
+        with _TraceSpan('compile build script', path=script_path):
+            pycode = compile(script, script_path, mode='exec')
     except SyntaxError as ex:
         msg =  "SyntaxError in (%s, line %d):\n\t%s\n" \
                % (ex.filename, ex.lineno, ex.text)
         _fatal_error(msg)
+
+    try:
+        _write_atomic(cache_path,
+                      marshal.dumps(cache_key) + marshal.dumps(pycode))
+    except OSError as e:
+        _message(1, "could not write script cache: %s" % e)
+
+    _script_memo[cache_key] = pycode
     return pycode
 
+_script_memo = {}  # script cache key -> code object
+
+def _script_cache_key(script_path, script):
+    """the compiled script is reused only if all of these match, similar
+    to __pycache__.  the interpreter is part of it because code objects
+    are not portable between Python versions."""
+    import hashlib
+    st = os.stat(script_path)
+    return (os.path.abspath(script_path), st.st_size, st.st_mtime_ns,
+            hashlib.blake2b(script, digest_size=16).digest(),
+            sys.implementation.cache_tag, sys.hexversion, VERSION)
+
+def _load_script_cache(cache_path, cache_key):
+    """compiled code object from cache_path, or None if it is stale"""
+    try:
+        with open(cache_path, 'rb') as f:
+            if marshal.load(f) != cache_key:
+                return None
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
 def _swap_slashes(dir):
-    if platform.system() == 'Windows':
+    if _host_os() == 'Windows':
         return dir.replace('/', '\\')
     else:
         return dir.replace('\\', '/')
@@ -357,6 +583,7 @@ def _add_api(g):
     g['use'] = _api_use
     g['arg'] = _api_arg
     g['obj'] = _api_obj
+    g['pch'] = _api_pch
     g['var'] = _api_var
     g['yes'] = _api_yes
     g['exe'] = _api_exe
@@ -364,16 +591,45 @@ def _add_api(g):
     g['exp'] = _api_exp
     g['pth'] = _api_pth
     g['raw'] = _api_raw
+    g['job'] = _api_job
+    g['new'] = _api_new
+    g['cmd_async'] = _api_cmd_async
+    g['wait_all'] = _api_wait_all
     return g
 
-def _run_script(pycode, target_os):
-    globals()['TARGET_OS'] = target_os    
-    g = _add_api(globals())
+def _run_script(pycode, target_os, build_vars=None, variant=None):
+    """execute the build script and return its context.
 
-    push_name = globals()['__name__']
-    globals()['__name__'] = '__jfdi__'
-    exec(pycode, g)
-    globals()['__name__'] = push_name
+    The script runs in jfdi's globals unless build_vars are given.  Then
+    it gets a copy of them with its own build vars, use() variables and
+    toolchain, so several variants of the script can be loaded at once.
+    """
+    if build_vars == None:
+        g = globals()
+    else:
+        g = dict(globals())
+        g['_cfg'] = dict(_cfg, build_vars=build_vars)
+        g['_toolchain'] = {}
+        g['_pch'] = {'entries': {} }
+        g['_variant'] = variant
+
+    g['TARGET_OS'] = target_os
+    _add_api(g)
+
+    push_ns = getattr(_current, 'ns', None)
+    _current.ns = g
+    try:
+        context = _exec_script(pycode, g)
+    finally:
+        _current.ns = push_ns
+    return context
+
+def _exec_script(pycode, g):
+    push_name = g['__name__']
+    g['__name__'] = '__jfdi__'
+    with _TraceSpan('run build script'):
+        exec(pycode, g)
+    g['__name__'] = push_name
 
     #
     # validate expected functions
@@ -399,70 +655,2150 @@ def _run_script(pycode, target_os):
         _fatal_error("JFDI %s%s\n" % (_pp_version(), error_result))
         
     
-    context = [globals()]
+    context = [g]
     return context
 
+#
+# script namespaces
+#
+# API functions read and write the variables of the build script that
+# called them, eg. use() sets CC.  That is jfdi's globals, or with
+# --variants, the namespace of the variant built on the calling thread.
+#
+_current = _thread._local()  # .ns: script namespace used by this thread
+
+# --variants label of a script namespace, eg. 'DEBUG=1'
+_variant = None
+
+def _ns():
+    """namespace of the build script running on this thread"""
+    ns = getattr(_current, 'ns', None)
+    if ns == None:
+        return globals()
+    return ns
+
+def _build_vars():
+    return _ns()['_cfg']['build_vars']
+
 def _handle_input_files(input_files):
+    return list(_iter_input_files(input_files))
+
+def _iter_input_files(input_files):
+    """lazily expand the return value of list_input_files() into paths.
+
+    Entries containing '*' are wildcards.  '**' matches any number of
+    subdirectories.  Entries starting with '!' exclude matching paths; when
+    list_input_files() returns a list they apply to the whole list,
+    otherwise to the entries that follow them.
+
+    Each run of consecutive wildcards is expanded by a single walk of the
+    directory tree, yielding matches in sorted order.  A path is only
+    yielded once.  Iterators are consumed, and directories walked, only as
+    paths are needed.
+    """
     if input_files.__class__ == str:
         input_files = [input_files]
 
-    out_paths = []
-        
+    excludes = []
+    if input_files.__class__ == list or input_files.__class__ == tuple:
+        excludes = [_compile_glob(e[1:]) for e in input_files
+                    if e.startswith('!')]
+        look_ahead = True
+    else:
+        look_ahead = False
+
+    seen = set()
+    def is_new(norm):
+        if norm in seen:
+            return False
+        seen.add(norm)
+        return not any(x.rx.fullmatch(norm) for x in excludes)
+
+    pending = []
     for entry in input_files:
+        if entry.startswith('!'):
+            if not look_ahead:
+                excludes.append(_compile_glob(entry[1:]))
+            continue
+
         if '*' in entry:
-            wildcard = glob.glob(entry)
-            for path in wildcard:
-                out_paths.append(path)
+            pending.append(_compile_glob(entry))
+            continue
+
+        for path, norm in _walk_globs(pending, excludes):
+            if is_new(norm):
+                yield path
+        pending = []
+
+        if is_new(_glob_norm(entry)):
+            yield entry
+
+    for path, norm in _walk_globs(pending, excludes):
+        if is_new(norm):
+            yield path
+
+
+class _Glob:
+    """a wildcard split into the literal directory it starts from and
+    a regex for each path component below that"""
+    def __init__(self, pattern, base, parts):
+        import re
+        self.pattern = pattern
+        self.base = base
+        # one regex per component, None for '**'
+        self.parts = [None if p == '**' else re.compile(_glob_part_regex(p))
+                      for p in parts]
+        # regex over the path relative to base
+        self.rel_rx = re.compile(_glob_path_regex(parts))
+        # regex over the whole path, for exclusions
+        self.rx = re.compile(_glob_path_regex(_glob_split(pattern)))
+        # '!dir/**' exclusions skip walking dir entirely
+        self.dir_rx = None
+        if len(parts) != 0 and parts[-1] == '**':
+            self.dir_rx = re.compile(
+                _glob_path_regex(_glob_split(pattern)[:-1]))
+
+    def could_match_below(self, dir_parts):
+        """true if a path below the directory base/dir_parts can match"""
+        i = 0
+        for name in dir_parts:
+            if i >= len(self.parts):
+                return False
+
+            if self.parts[i] == None:
+                # '**' does not descend into hidden directories unless a
+                # later component names them explicitly
+                if name[0] == '.':
+                    return any(p != None and p.fullmatch(name)
+                               for p in self.parts[i + 1:])
+                continue
+
+            if not self.parts[i].fullmatch(name):
+                return False
+            i += 1
+
+        return i < len(self.parts)
+
+def _glob_split(pattern):
+    if os.sep == '\\':
+        pattern = pattern.replace('\\', '/')
+    parts = pattern.split('/')
+    # './src/*.c' and 'src/*.c' are the same pattern
+    while len(parts) > 1 and parts[0] == '.':
+        parts = parts[1:]
+    return parts
+
+def _glob_norm(path):
+    """path in the form wildcards are matched against"""
+    return os.path.normpath(path).replace(os.sep, '/')
+
+def _compile_glob(pattern):
+    # unlike _glob_split(), keep a leading './' so paths come out the way
+    # glob.glob() would return them
+    if os.sep == '\\':
+        pattern = pattern.replace('\\', '/')
+    parts = pattern.split('/')
+
+    # leading components without wildcards are where the walk starts
+    num_literal = 0
+    while num_literal < len(parts) - 1 and \
+          not any(c in parts[num_literal] for c in '*?['):
+        num_literal += 1
+
+    base = '/'.join(parts[:num_literal])
+    if base == '' and num_literal != 0:
+        base = '/'
+    return _Glob(pattern, base, parts[num_literal:])
+
+def _glob_part_regex(part):
+    """regex for one path component, following glob's rules: wildcards
+    stay within the component and a leading wildcard skips dotfiles"""
+    import re
+    out = ''
+    i = 0
+    while i < len(part):
+        c = part[i]
+        if c == '*':
+            out += '[^/]*'
+        elif c == '?':
+            out += '[^/]'
+        elif c == '[':
+            j = part.find(']', i + 2)
+            if j == -1:
+                out += '\\['
+            else:
+                chars = part[i + 1:j].replace('\\', '\\\\')
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                out += '[' + chars + ']'
+                i = j
         else:
-            out_paths.append(entry)
+            out += re.escape(c)
+        i += 1
 
-    return out_paths
+    if part[:1] in ('*', '?', '['):
+        out = '(?!\\.)' + out
+    return out
+
+def _glob_path_regex(parts):
+    out = ''
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == '**' and last:
+            out += '(?!\\.)[^/]+(?:/(?!\\.)[^/]+)*'
+        elif part == '**':
+            out += '(?:(?!\\.)[^/]+/)*'
+        else:
+            out += _glob_part_regex(part)
+            if not last:
+                out += '/'
+    return out
+
+def _walk_globs(globs, excludes):
+    """yield (path, normalized path) for each path matching any of globs.
+    Each base directory is walked once for all of the globs that start
+    from it."""
+    import re
+    by_base = {}
+    for g in globs:
+        by_base.setdefault(g.base, []).append(g)
+
+    dir_excludes = [x for x in excludes if x.dir_rx != None]
+
+    for base, base_globs in by_base.items():
+        norm_base = _glob_norm(base) + '/' if base != '' else ''
+        if norm_base == './':
+            norm_base = ''
+
+        # directories still to list: (path, components below base, globs
+        # that could match below it).  popped in sorted order.
+        stack = [(base, [], base_globs)]
+        while len(stack) != 0:
+            dir_path, dir_parts, dir_globs = stack.pop()
+            try:
+                entries = _list_dir(dir_path or '.')
+            except OSError:
+                continue
+
+            # one regex test per entry, whatever the number of globs
+            match = re.compile('|'.join('(?:%s)' % g.rel_rx.pattern
+                                        for g in dir_globs)).fullmatch
+            rel_prefix = ''.join(p + '/' for p in dir_parts)
+            path_prefix = dir_path + os.sep if dir_path != '' else ''
+            if dir_path.endswith(os.sep) or dir_path.endswith('/'):
+                path_prefix = dir_path
+
+            sub_dirs = []
+            for name, is_dir in entries:
+                rel_path = rel_prefix + name
+                if match(rel_path):
+                    yield path_prefix + name, norm_base + rel_path
+
+                if not is_dir:
+                    continue
+
+                sub_parts = dir_parts + [name]
+                below = [g for g in dir_globs
+                         if g.could_match_below(sub_parts)]
+                if len(below) == 0:
+                    continue
+
+                if any(x.dir_rx.fullmatch(norm_base + rel_path)
+                       for x in dir_excludes):
+                    continue
+                sub_dirs.append((path_prefix + name, sub_parts, below))
+
+            stack.extend(reversed(sub_dirs))
+
+def _list_dir(dir_path):
+    """sorted list of (name, is dir) for the entries of dir_path"""
+    if _cfg['dir_cache']:
+        return _dir_cache_list(dir_path)
+
+    return _scan_dir(dir_path)
+
+def _scan_dir(dir_path):
+    entries = []
+    for e in os.scandir(dir_path):
+        try:
+            is_dir = e.is_dir()
+        except OSError:
+            is_dir = False
+        entries.append((e.name, is_dir))
+    entries.sort()
+    return entries
+
+
+#
+# directory listing cache
+#
+# Adding, removing or renaming an entry updates its directory's mtime, so
+# a directory whose mtime (and inode) match the cache is not listed again.
+# A no-op build then costs one stat() per directory walked instead of a
+# full listing, which matters on network filesystems.
+#
+# A directory modified within _DIR_CACHE_RACY_NS of being listed might
+# change again without its mtime moving, given coarse timestamps or
+# clock skew with a file server.  Such listings are kept for this run but
+# are not trusted by the next one.
+#
+_DIR_CACHE_VERSION = 1
+_DIR_CACHE_RACY_NS = 2 * 1000 * 1000 * 1000
+
+_dir_cache = {'loaded': False,
+              'dirty': False,
+              'lock': _thread.allocate_lock(),
+              'dirs': {} }  # dir path -> (mtime_ns, inode, names, is dirs)
+
+def _dir_cache_path():
+    return os.path.join(_cfg['state_dir'], 'dirs')
+
+def _load_dir_cache():
+    if _dir_cache['loaded']:
+        return
+    _dir_cache['loaded'] = True
+
+    try:
+        with open(_dir_cache_path(), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+
+    # paths are relative to the directory jfdi was run from
+    if data.__class__ != dict or \
+       data.get('version') != _DIR_CACHE_VERSION or \
+       data.get('cwd') != os.getcwd():
+        return
+
+    _dir_cache['dirs'] = data['dirs']
+
+def _save_dir_cache():
+    if not _dir_cache['dirty']:
+        return
+
+    with _dir_cache['lock']:
+        data = {'version': _DIR_CACHE_VERSION,
+                'cwd': os.getcwd(),
+                'dirs': _dir_cache['dirs']}
+        _write_atomic(_dir_cache_path(), marshal.dumps(data))
+        _dir_cache['dirty'] = False
+
+def _dir_cache_list(dir_path):
+    _load_dir_cache()
+    st = os.stat(dir_path)
+
+    # names are stored '/' separated, which loads far faster than a
+    # tuple per entry
+    cached = _dir_cache['dirs'].get(dir_path)
+    if cached != None and cached[0] == st.st_mtime_ns and \
+       cached[1] == st.st_ino:
+        if cached[2] == '':
+            return []
+        return list(zip(cached[2].split('/'), cached[3]))
+
+    listed_ns = time.time_ns()
+    entries = _scan_dir(dir_path)
+
+    # a racy mtime is recorded as None, which never matches
+    mtime_ns = st.st_mtime_ns
+    if mtime_ns > listed_ns - _DIR_CACHE_RACY_NS:
+        mtime_ns = None
+
+    with _dir_cache['lock']:
+        _dir_cache['dirs'][dir_path] = (mtime_ns, st.st_ino,
+                                        '/'.join(e[0] for e in entries),
+                                        bytes(e[1] for e in entries))
+        _dir_cache['dirty'] = True
+    return entries
 
 
 def _build(context, target_os):
-    globals()['HOST_OS'] = platform.system()
-    globals()['TARGET_OS'] = target_os
+    context[0]['HOST_OS'] = _host_os()
+    context[0]['TARGET_OS'] = target_os
         
-    input_files = context[0]['list_input_files']()
-    input_files = _handle_input_files(input_files)
+    with _TraceSpan('list_input_files'):
+        input_files = context[0]['list_input_files']()
 
-    context[0]['start_build']()
-        
-    cmd_list = []
+    with _TraceSpan('start_build'):
+        context[0]['start_build']()
+
+    # wildcards and iterators from list_input_files() are expanded while
+    # the first jobs are already compiling
+    input_files = _iter_input_files(input_files)
+    if _cfg['unity'] != 0:
+        input_files = _unity_sources(list(input_files), _cfg['unity'])
+    else:
+        _unity_forget()
+    input_files = _build_files(context, input_files)
+
+    # another variant's command failed in the shared pool
+    if _active_pool != None and _active_pool.has_failed():
+        return
+
+    with _TraceSpan('end_build'):
+        context[0]['end_build'](input_files)
+    _api_wait_all()
+
+
+def _build_files(context, input_files):
+    """call build_this() on each of input_files, running the resulting jobs
+    as soon as they are returned.  returns input_files as a list
+
+    With --variants, the jobs go to the pool shared by all variants, and
+    this waits for its own jobs only.
+    """
+    global _active_pool
+    shared = _active_pool != None
+    if shared:
+        pool = _active_pool
+    else:
+        # files may have changed since the last call when watching
+        _build_log['seen'] = {}
+        pool = _JobPool(_cfg['jobs'])
+        _active_pool = pool
+    submitted = []
+    seen_files = []
+    num_commands = 0
+    num_up_to_date = 0
+    num_building = 0
+
+    # precompiled headers start first.  jobs that use one that is being
+    # rebuilt must rebuild too, whatever their own inputs say.
+    rebuilding = []
+    for entry in context[0]['_pch']['entries'].values():
+        job = _pch_job(context[0], entry)
+        if not _cfg['always'] and _is_up_to_date(job):
+            _message(1, "up to date: %s" % ' '.join(job.outputs))
+            job.finished = True
+            continue
+        rebuilding.append(job)
+        pool.submit(job)
+        submitted.append(job)
+        num_commands += 1
     for path in input_files:
-        cmd = context[0]['build_this'](path)
-        if cmd != None:
-            cmd_list.append(cmd)
+        seen_files.append(path)
 
-    _message(1, "building %d/%d file(s)" %
-             (len(cmd_list), len(input_files)))
-    
-    for cmd in cmd_list:
-        _run_cmd(cmd)
+        # no point in starting more work once a job or a cmd_async()
+        # command has failed
+        if pool.has_failed() or _async['failed']:
+            continue
+
+        with _TraceSpan('build_this', path=path):
+            cmds = context[0]['build_this'](path)
+        if cmds == None:
+            continue
+
+        jobs = []
+        for job in _to_jobs(cmds, path):
+            if any(a in rebuilding for a in job.after):
+                job.cmd_hash = job.input_hash = None
+            elif not _cfg['always'] and _is_up_to_date(job):
+                _message(1, "up to date: %s" % ' '.join(job.outputs))
+                num_up_to_date += 1
+                continue
+            jobs.append(job)
+
+        if len(jobs) != 0:
+            num_building += 1
+        for job in jobs:
+            pool.submit(job)
+        submitted += jobs
+        num_commands += len(jobs)
+
+    _message(1, "building %d/%d file(s): %d command(s) on %d job(s), " %
+             (num_building, len(seen_files), num_commands, _cfg['jobs']) +
+             "%d up to date" % num_up_to_date)
+
+    if shared:
+        for job in submitted:
+            pool.wait_for(job)
+    else:
+        # jobs that succeeded before a failure are still logged, so they
+        # are not rerun next time.
+        try:
+            pool.wait()
+        finally:
+            _active_pool = None
+            _save_state()
+
+    # a failed cmd_async() command stops the build before end_build()
+    if _async['failed']:
+        _api_wait_all()
+
+    return seen_files
+
+def _save_state():
+    _save_build_log()
+    _save_deps()
+    _save_dir_cache()
+    _cache_trim()
 
-    context[0]['end_build'](input_files)
+#
+# --variants
+#
+# Each variant loads the build script into a namespace of its own, see
+# _run_script(), and is built on its own thread.  Their jobs go to one
+# shared pool, so -j bounds them all and their compiles interleave.  A
+# failing command stops every variant before end_build().
+#
+def _build_variants(pycode, variants, run):
+    """build each (label, target os, build vars) variant concurrently,
+    then call run() on each if run is set"""
+    import threading
+    global _active_pool
+    if _cfg['unity'] != 0:
+        _fatal_error("--unity cannot be combined with --variants\n")
+
+    contexts = _load_variants(pycode, variants)
+
+    # loaded up front, so variants do not race to load them
+    _load_build_log()
+    _load_deps()
+    _load_toolchain_cache()
+    if _cfg['dir_cache']:
+        _load_dir_cache()
+
+    _build_log['seen'] = {}
+    pool = _JobPool(_cfg['jobs'])
+    _active_pool = pool
+    errors = []
+
+    def build_variant(context):
+        _current.ns = context[0]
+        _trace_thread_name("variant %s" % context[0]['_variant'])
+        try:
+            _build(context, context[0]['TARGET_OS'])
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=build_variant, args=(context,),
+                                daemon=True)
+               for context in contexts]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        pool.wait()
+    finally:
+        _active_pool = None
+        _save_state()
+
+    # eg. a die() in one variant, once the others have finished
+    if len(errors) != 0:
+        raise errors[0]
+
+    if run:
+        for context in contexts:
+            _current.ns = context[0]
+            _canonical_run(context, context[0]['TARGET_OS'])
+        _current.ns = None
+
+def _clean_variants(pycode, variants):
+    for context in _load_variants(pycode, variants):
+        _current.ns = context[0]
+        _clean(context, context[0]['TARGET_OS'])
+    _current.ns = None
+
+def _load_variants(pycode, variants):
+    contexts = []
+    for label, target_os, build_vars in variants:
+        _message(1, "loading variant %s" % label)
+        contexts.append(_run_script(pycode, target_os, build_vars, label))
+    return contexts
 
     
+#
+# unity builds
+#
+# --unity N batches C and C++ input files into about N generated sources,
+# each #including a run of files from the same directory, split so the
+# batches are of similar total size.  build_this() and end_build() see
+# the generated sources in place of their members, and obj() maps both
+# to the unity object, so scripts need no changes.
+#
+# The batches are kept in .jfdi/unity/map.  Files keep their batch from
+# one build to the next and new files join the smallest batch from their
+# directory, so editing, adding or removing a file rebuilds one batch.
+# clean loads the map too, so obj() names the unity objects to remove.
+# A build without --unity removes it.
+#
+_UNITY_VERSION = 1
+_UNITY_EXTS = {'.c': 'c',
+               '.cc': 'cpp', '.cpp': 'cpp', '.cxx': 'cpp', '.c++': 'cpp'}
+
+_unity = {'members': {},  # normalized member path -> unity source
+          'sources': set() }
+
+def _unity_dir():
+    return os.path.join(_cfg['state_dir'], 'unity')
+
+def _unity_sources(input_files, num_batches):
+    """return input_files with C and C++ files replaced by the unity
+    sources that include them"""
+    members = []
+    others = []
+    for path in input_files:
+        lang = _UNITY_EXTS.get(os.path.splitext(path)[1].lower())
+        if lang == None:
+            others.append(path)
+        else:
+            members.append((lang, os.path.normpath(path)))
+
+    batches, next_id = _unity_load(num_batches)
+    member_langs = dict((m, lang) for lang, m in members)
+
+    # forget files that are gone, then place new ones
+    placed = set()
+    for batch_id in list(batches):
+        lang, files = batches[batch_id]
+        files = [f for f in files if member_langs.get(f) == lang]
+        if len(files) == 0:
+            del batches[batch_id]
+            continue
+        batches[batch_id] = (lang, files)
+        placed.update(files)
+
+    new_members = [(lang, m) for lang, m in members if m not in placed]
+    if len(batches) == 0:
+        for batch in _unity_split(new_members, num_batches):
+            batches[next_id] = batch
+            next_id += 1
+    else:
+        next_id = _unity_place(batches, new_members, next_id)
+
+    _unity_save(num_batches, batches, next_id)
+
+    # one source per batch.  stale sources are removed.
+    os.makedirs(_unity_dir(), exist_ok=True)
+    _unity_set_members(batches)
+    sources = []
+    for batch_id in sorted(batches):
+        lang, files = batches[batch_id]
+        src = _unity_source_path(batch_id, lang)
+        text = '/* generated by jfdi --unity.  do not edit */\n'
+        for f in files:
+            text += '#include "%s"\n' % os.path.abspath(f)
+        _write_if_changed(src, text)
+        sources.append(src)
+
+    for e in os.scandir(_unity_dir()):
+        path = os.path.join(_unity_dir(), e.name)
+        if e.name.startswith('unity_') and path not in _unity['sources']:
+            os.remove(path)
+
+    _message(1, "unity: %d file(s) in %d source(s)" %
+             (len(members), len(sources)))
+    return sources + others
+
+def _unity_source_path(batch_id, lang):
+    return os.path.join(_unity_dir(), 'unity_%d.%s' % (batch_id, lang))
+
+def _unity_set_members(batches):
+    """point obj() at the unity sources of batches"""
+    _unity['members'] = {}
+    for batch_id, (lang, files) in batches.items():
+        for f in files:
+            _unity['members'][f] = _unity_source_path(batch_id, lang)
+    _unity['sources'] = set(_unity['members'].values())
+
+def _unity_load_members():
+    """point obj() at the unity sources of the last --unity build, if
+    there was one"""
+    data = _unity_read()
+    if data != None:
+        _unity_set_members(data['batches'])
+
+def _unity_forget():
+    """remove the map of an earlier --unity build"""
+    try:
+        os.remove(os.path.join(_unity_dir(), 'map'))
+    except OSError:
+        pass
+
+def _unity_cost(path):
+    """estimated compile cost of a member: its size"""
+    try:
+        return max(1, os.stat(path).st_size)
+    except OSError:
+        return 1
+
+def _unity_split(members, num_batches):
+    """split members into about num_batches (lang, files) batches of
+    similar total cost, cutting at directory boundaries where possible"""
+    members = sorted(members, key=lambda m: (m[0], os.path.dirname(m[1]),
+                                             m[1]))
+    costs = [_unity_cost(m) for lang, m in members]
+    target = sum(costs) / max(1, num_batches)
+
+    batches = []
+    for (lang, path), c in zip(members, costs):
+        if len(batches) != 0:
+            batch_lang, files, cost = batches[-1]
+            new_dir = os.path.dirname(path) != os.path.dirname(files[-1])
+            if lang == batch_lang and cost < target and \
+               not (new_dir and cost >= target / 2):
+                files.append(path)
+                batches[-1] = (lang, files, cost + c)
+                continue
+        batches.append((lang, [path], c))
+
+    return [(lang, files) for lang, files, cost in batches]
+
+def _unity_place(batches, new_members, next_id):
+    """add new members to the cheapest batch of their language, from
+    their own directory if there is one.  returns the next free id"""
+    if len(new_members) == 0:
+        return next_id
+
+    costs = {}
+    for batch_id, (lang, files) in batches.items():
+        costs[batch_id] = sum(_unity_cost(f) for f in files)
+
+    for lang, path in sorted(new_members):
+        same_lang = [b for b in batches if batches[b][0] == lang]
+        same_dir = [b for b in same_lang
+                    if any(os.path.dirname(f) == os.path.dirname(path)
+                           for f in batches[b][1])]
+        candidates = same_dir or same_lang
+        if len(candidates) == 0:
+            batches[next_id] = (lang, [])
+            costs[next_id] = 0
+            candidates = [next_id]
+            next_id += 1
+
+        batch_id = min(candidates, key=lambda b: costs[b])
+        batches[batch_id][1].append(path)
+        costs[batch_id] += _unity_cost(path)
+    return next_id
+
+def _unity_read():
+    """the map saved by the last --unity build, or None"""
+    try:
+        with open(os.path.join(_unity_dir(), 'map'), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if data.__class__ != dict or data.get('version') != _UNITY_VERSION:
+        return None
+    return data
+
+def _unity_load(num_batches):
+    """(batches, next id) from the last build with the same N"""
+    data = _unity_read()
+    if data == None or data.get('batches_wanted') != num_batches:
+        return {}, 0
+
+    return data['batches'], data['next_id']
+
+def _unity_save(num_batches, batches, next_id):
+    data = {'version': _UNITY_VERSION,
+            'batches_wanted': num_batches,
+            'batches': batches,
+            'next_id': next_id}
+    _write_atomic(os.path.join(_unity_dir(), 'map'), marshal.dumps(data))
+
+
 def _canonical_run(context, target_os):
     # not an error to have this omitted in the build script; run() is optional
     if 'run' not in context[0]:
         return
 
-    globals()['HOST_OS'] = platform.system()
-    globals()['TARGET_OS'] = target_os
+    context[0]['HOST_OS'] = _host_os()
+    context[0]['TARGET_OS'] = target_os
 
     _message(1, "performing a canonical run of the build product")
-    globals()['TARGET_OS'] = target_os    
     context[0]['run']()
+    _api_wait_all()
+
+
+def _watch(context, target_os, args):
+    """build, then rebuild input files as they change until ctrl-c.
+
+    The build script is loaded and start_build() is called once.  Each
+    batch of changes calls build_this() on the changed input files and
+    end_build() once.  A changed header rebuilds every input file, leaving
+    the build log to decide which are really out of date.
+    """
+    context[0]['HOST_OS'] = _host_os()
+    context[0]['TARGET_OS'] = target_os
+
+    context[0]['start_build']()
+
+    script_path = os.path.normpath(args.file)
+    watcher = None
+    changed = None  # None builds every input file
+    known_inputs = set()
+
+    while True:
+        try:
+            input_files = context[0]['list_input_files']()
+            input_files = _handle_input_files(input_files)
+            if _cfg['unity'] != 0:
+                # members are watched as headers of their unity source
+                input_files = _unity_sources(input_files, _cfg['unity'])
+            else:
+                _unity_forget()
+            norm_inputs = {os.path.normpath(p): p for p in input_files}
+
+            if changed == None:
+                to_build = input_files
+            elif any(p not in norm_inputs for p in changed
+                     if p in _watched_headers()):
+                to_build = input_files
+            else:
+                to_build = [p for n, p in norm_inputs.items()
+                            if n in changed or n not in known_inputs]
+
+            known_inputs = set(norm_inputs)
+            if changed == None or len(to_build) != 0:
+                _build_files(context, to_build)
+                context[0]['end_build'](input_files)
+                _api_wait_all()
+                _message(0, "build succeeded; watching for changes")
+            changed = set()
+
+        except SystemExit:
+            # a failed command or die().  retry everything next time,
+            # the build log skips whatever already succeeded.
+            _message(0, "build failed; watching for changes")
+            changed = None
+
+        watch_paths = set(known_inputs)
+        watch_paths.update(_watched_headers())
+        watch_paths.add(script_path)
+        if watcher == None:
+            watcher = _make_watcher(args.poll)
+        watcher.update(watch_paths)
+
+        # block for the first change, then keep collecting until things
+        # go quiet for the debounce window
+        batch = watcher.wait(None)
+        while True:
+            more = watcher.wait(args.debounce / 1000.0)
+            if len(more) == 0:
+                break
+            batch.update(more)
+
+        if script_path in batch:
+            _warning("%s changed; restart jfdi watch to reload it\n" %
+                     args.file)
+
+        if changed != None:
+            changed = batch
+
+def _watched_headers():
+    _load_deps()
+    return set(os.path.normpath(p) for p in _deps['paths'])
+
+def _make_watcher(force_poll):
+    if not force_poll and sys.platform.startswith('linux'):
+        try:
+            return _InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            _warning("inotify unavailable (%s); polling for changes\n" % e)
+
+    return _PollWatcher()
+
+class _PollWatcher:
+    """detect changed files by comparing stat() results every interval"""
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.states = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def update(self, paths):
+        # directories catch files being added next to existing inputs
+        dirs = set(os.path.dirname(p) or '.' for p in paths)
+        self.states = {p: self._stat(p) for p in set(paths) | dirs}
+
+    def wait(self, timeout):
+        waited = 0.0
+        while True:
+            changed = set()
+            for path, state in self.states.items():
+                new_state = self._stat(path)
+                if new_state != state:
+                    self.states[path] = new_state
+                    changed.add(path)
+
+            if len(changed) != 0:
+                return changed
+
+            if timeout != None and waited >= timeout:
+                return changed
+            time.sleep(self.INTERVAL)
+            waited += self.INTERVAL
+
+class _InotifyWatcher:
+    """detect changed files with linux inotify, through ctypes.
+
+    Directories are watched rather than files, so editors that save by
+    renaming a new file over the old one are still noticed.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_CLOEXEC     = 0o2000000
+
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> directory
+
+    def update(self, paths):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | \
+               self.IN_CREATE | self.IN_DELETE
+        watched = set(self.dirs.values())
+        for d in set(os.path.dirname(p) or '.' for p in paths):
+            if d in watched:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def wait(self, timeout):
+        import select
+        import struct
+
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if len(ready) == 0:
+            return set()
+
+        buf = os.read(self.fd, 64 * 1024)
+        changed = set()
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, name_len = struct.unpack_from('iIII', buf, i)
+            i += 16
+            name = buf[i:i + name_len].rstrip(b'\0')
+            i += name_len
+
+            if wd in self.dirs and len(name) != 0:
+                path = os.path.join(self.dirs[wd], os.fsdecode(name))
+                changed.add(os.path.normpath(path))
+        return changed
+
+class _Job:
+    """a command to run, with the files it reads and writes.
+
+    build_this() returns one of these from job() when it wants the command
+    skipped while its outputs are up to date.  Bare command strings are
+    wrapped in a _Job with no outputs, so they always run.
+    """
+    def __init__(self, cmd, inputs=None, outputs=None, deps=None):
+        if cmd.__class__ == list:
+            cmd = ' '.join(cmd)
+        self.cmd = cmd
+        self.inputs = list(_str_to_list(inputs)) if inputs != None else []
+        self.outputs = list(_str_to_list(outputs)) if outputs != None else []
+
+        # header dependency style: 'gcc', 'msvc' or False.  None means
+        # detect from the compiler selected by use().
+        self.deps = deps
+
+        # input file whose build_this() returned this job
+        self.source = None
+
+        # script namespace that made the job, see _ns()
+        self.ns = _ns()
+
+        # jobs that must finish before this one starts, eg. a pch()
+        self.after = []
+        self.finished = False
+
+        # expected seconds to run, and that plus the longest chain of
+        # jobs waiting on it.  set by _JobPool.submit()
+        self.cost = 0.0
+        self.priority = 0.0
+
+        # filled in by _is_up_to_date() for the build log
+        self.cmd_hash = None
+        self.input_hash = None
+
+    def __str__(self):
+        return self.cmd
+
+
+def _to_jobs(cmds, in_path):
+    """convert a build_this() return value into a list of _Jobs.
+
+    build_this() may return one command or job(), or a list of them to
+    fan a single input file out into several independent jobs.
+    """
+    if cmds.__class__ == list or cmds.__class__ == tuple:
+        return [_to_job(cmd, in_path) for cmd in cmds if cmd != None]
+    return [_to_job(cmds, in_path)]
+
+def _to_job(cmd, in_path):
+    """convert a single command or job() into a _Job"""
+    if cmd.__class__ != _Job:
+        job = _Job(cmd, [in_path])
+        job.source = in_path
+        _add_pch_after(job)
+        return job
+
+    if len(cmd.inputs) == 0:
+        cmd.inputs = [in_path]
+    cmd.source = in_path
+    _add_dep_flags(cmd)
+    _add_pch_after(cmd)
+    return cmd
+
+
+def _add_dep_flags(job):
+    """make a compile job report the headers it includes.
+
+    The compiler is asked for a depfile (gcc, clang) or to list includes
+    on stdout (msvc).  Only compile jobs (-c or /c) with outputs are
+    considered, since the headers are tracked per output.
+    """
+    if job.deps == None:
+        job.deps = False
+        g = _ns()
+        if 'CCTYPE' in g and len(job.outputs) != 0:
+            # LD is often the compiler too; only compiles have headers
+            tokens = job.cmd.split(' ')
+            if (job.cmd.startswith(g['CC'] + ' ') or
+                job.cmd.startswith(g['CXX'] + ' ')) and \
+               ('-c' in tokens or '/c' in tokens):
+                job.deps = g['CCTYPE']
+
+    if job.deps == 'gcc':
+        job.cmd += ' -MMD -MF %s' % _depfile_path(job)
+    elif job.deps == 'msvc':
+        job.cmd += ' /showIncludes'
+    elif job.deps != False:
+        _fatal_error("job(): unknown deps '%s'.  " % job.deps +
+                     "Use 'gcc', 'msvc' or False\n")
+
+
+def _hash_job(job):
+    """hash job's command and inputs for the build log.  false if an
+    input or recorded header is missing"""
+    # hashed before the command starts so the log records the inputs as
+    # they were when it ran.  a missing input is left for the command
+    # itself to report, and a missing header means it must be rebuilt.
+    job.cmd_hash = _hash_str(job.cmd)
+    try:
+        job.input_hash = _hash_inputs(job.inputs +
+                                      _deps_entry(job.outputs[0]))
+    except OSError:
+        job.input_hash = None
+        return False
+    return True
+
+def _forget_file_states(paths):
+    """drop paths a job just wrote from this run's stat() memo, so jobs
+    that read them hash their new contents"""
+    with _build_log['lock']:
+        for path in paths:
+            _build_log['seen'].pop(path, None)
+
+def _is_up_to_date(job):
+    """true if every output of job exists and the build log says it was
+    made by the same command from inputs with the same contents.
+
+    Outputs missing from the build log fall back to being up to date if
+    they are newer than every input.
+    """
+    if len(job.outputs) == 0:
+        return False
+
+    if not _hash_job(job):
+        return False
+
+    try:
+        oldest_out = min(os.stat(p).st_mtime_ns for p in job.outputs)
+    except OSError:
+        return False
+
+    entry = _build_log_entry(job.outputs[0])
+    if entry == None:
+        newest_in = max(_file_state(p)[0] for p in job.inputs)
+        return newest_in <= oldest_out
+
+    return entry == (job.cmd_hash, job.input_hash)
+
+
+#
+# build log
+#
+# The build log maps each job() output to a hash of the command that made
+# it and a hash of its inputs' contents.  A second table caches each
+# input's content hash by (mtime, size) so unchanged files are not reread.
+#
+# As with the directory cache, a file modified within _BUILD_LOG_RACY_NS
+# of being hashed might change again without its mtime or size moving.
+# Its hash is used for this run but not cached for the next one.
+#
+# It is stored with marshal and replaced atomically, so loading and
+# saving a large log costs little more than reading the file.
+#
+_BUILD_LOG_VERSION = 1
+_BUILD_LOG_RACY_NS = 2 * 1000 * 1000 * 1000
+
+_build_log = {'loaded': False,
+              'dirty': False,
+              'lock': _thread.allocate_lock(),
+              'outputs': {},  # out path -> (cmd hash, inputs hash)
+              'files': {},    # in path -> (mtime_ns, size, content hash)
+              'durations': {},  # job key -> (seconds, input bytes)
+              'seen': {} }    # files already stat()ed by this process
+
+def _build_log_path():
+    return os.path.join(_cfg['state_dir'], 'build_log')
+
+def _load_build_log():
+    if _build_log['loaded']:
+        return
+    _build_log['loaded'] = True
+
+    try:
+        with open(_build_log_path(), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+
+    if data.__class__ != dict or data.get('version') != _BUILD_LOG_VERSION:
+        _message(1, "ignoring build log from another version of jfdi")
+        return
+
+    _build_log['outputs'] = data['outputs']
+    _build_log['files'] = data['files']
+    _build_log['durations'] = data.get('durations', {})
+
+def _save_build_log():
+    if not _build_log['dirty']:
+        return
+
+    with _build_log['lock']:
+        data = {'version': _BUILD_LOG_VERSION,
+                'outputs': _build_log['outputs'],
+                'files': _build_log['files'],
+                'durations': _build_log['durations']}
+        _write_atomic(_build_log_path(), marshal.dumps(data))
+        _build_log['dirty'] = False
+
+def _write_atomic(path, data):
+    """write bytes to path so readers see either the old or new file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _build_log_entry(out_path):
+    _load_build_log()
+    return _build_log['outputs'].get(out_path)
+
+def _record_job(job, includes=None):
+    """log the outputs of a job that has just succeeded.
+
+    includes are the headers the compiler reported, if deps were tracked.
+    They replace any headers previously recorded for the job's output.
+    """
+    if len(job.outputs) == 0 or job.cmd_hash == None:
+        return
+
+    if includes != None:
+        _record_deps(job.outputs[0], includes)
+        # the header set may differ from the one hashed before the
+        # compile, which fails if a header recorded last time is gone.
+        # explicit inputs hash as they were when it started.
+        try:
+            job.input_hash = _hash_inputs(job.inputs + includes)
+        except OSError:
+            return
+    elif job.input_hash == None:
+        return
+
+    with _build_log['lock']:
+        for out_path in job.outputs:
+            _build_log['outputs'][out_path] = (job.cmd_hash, job.input_hash)
+        _build_log['dirty'] = True
+
+def _hash_str(s):
+    import hashlib
+    return hashlib.blake2b(s.encode('utf-8', 'surrogateescape'),
+                           digest_size=16).digest()
+
+def _file_state(path):
+    """(mtime_ns, size, content hash) of path, rehashing only if the
+    file's mtime or size changed since it was last hashed"""
+    import hashlib
+    # many outputs share the same headers; stat each one only once
+    state = _build_log['seen'].get(path)
+    if state != None:
+        return state
+
+    _load_build_log()
+    st = os.stat(path)
+
+    cached = _build_log['files'].get(path)
+    if cached != None and cached[0] == st.st_mtime_ns and \
+       cached[1] == st.st_size:
+        _build_log['seen'][path] = cached
+        return cached
+
+    hashed_ns = time.time_ns()
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    state = (st.st_mtime_ns, st.st_size, h.digest())
+    with _build_log['lock']:
+        _build_log['seen'][path] = state
+        if st.st_mtime_ns > hashed_ns - _BUILD_LOG_RACY_NS:
+            _build_log['files'].pop(path, None)
+        else:
+            _build_log['files'][path] = state
+        _build_log['dirty'] = True
+    return state
+
+def _hash_inputs(paths):
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        h.update(path.encode('utf-8', 'surrogateescape'))
+        h.update(_file_state(path)[2])
+    return h.digest()
+
+
+#
+# header dependency index
+#
+# Maps each compile job's first output to the headers the compiler said
+# it read.  Header paths are interned into a single table and each
+# output's list is stored as packed 32-bit ids, so tens of thousands of
+# headers load as one list plus a bytes object per output.
+#
+_DEPS_VERSION = 1
+
+_deps = {'loaded': False,
+         'dirty': False,
+         'paths': [],     # id -> header path
+         'ids': None,     # header path -> id, built on first record
+         'outputs': {} }  # out path -> packed array of header ids
+
+def _deps_path():
+    return os.path.join(_cfg['state_dir'], 'deps')
+
+def _load_deps():
+    if _deps['loaded']:
+        return
+    _deps['loaded'] = True
+
+    try:
+        with open(_deps_path(), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+
+    if data.__class__ != dict or data.get('version') != _DEPS_VERSION:
+        return
+
+    _deps['paths'] = data['paths']
+    _deps['outputs'] = data['outputs']
+
+def _save_deps():
+    if not _deps['dirty']:
+        return
+
+    with _build_log['lock']:
+        data = {'version': _DEPS_VERSION,
+                'paths': _deps['paths'],
+                'outputs': _deps['outputs']}
+        _write_atomic(_deps_path(), marshal.dumps(data))
+        _deps['dirty'] = False
+
+def _deps_entry(out_path):
+    """list of headers recorded for out_path"""
+    import array
+    _load_deps()
+    packed = _deps['outputs'].get(out_path)
+    if packed == None:
+        return []
+
+    ids = array.array('I')
+    ids.frombytes(packed)
+    paths = _deps['paths']
+    return [paths[i] for i in ids]
+
+def _record_deps(out_path, includes):
+    import array
+    _load_deps()
+    with _build_log['lock']:
+        if _deps['ids'] == None:
+            _deps['ids'] = {p: i for i, p in enumerate(_deps['paths'])}
+
+        ids = array.array('I')
+        for path in includes:
+            i = _deps['ids'].get(path)
+            if i == None:
+                i = len(_deps['paths'])
+                _deps['paths'].append(path)
+                _deps['ids'][path] = i
+            ids.append(i)
+
+        _deps['outputs'][out_path] = ids.tobytes()
+        _deps['dirty'] = True
+
+def _depfile_path(job):
+    return job.outputs[0] + '.d'
+
+def _parse_depfile(text):
+    """list of prerequisites in a make-style depfile written by -MMD"""
+    # join continuation lines, then drop the 'target:' prefix
+    text = text.replace('\\\r\n', ' ').replace('\\\n', ' ')
+    paths = []
+    for line in text.splitlines():
+        # ': ' rather than ':' to keep windows drive letters intact
+        split = line.split(': ', 1)
+        if len(split) != 2:
+            continue
+
+        rule = split[1]
+        if '\\ ' not in rule:
+            paths.extend(rule.split())
+            continue
+
+        # escaped spaces in paths
+        for token in rule.replace('\\ ', '\0').split():
+            paths.append(token.replace('\0', ' '))
+
+    return paths
+
+def _read_depfile(job):
+    """headers listed in a gcc depfile.  the depfile is removed once read"""
+    depfile = _depfile_path(job)
+    try:
+        # paths are bytes to the compiler, whatever the locale says
+        with open(depfile, 'rb') as f:
+            paths = _parse_depfile(os.fsdecode(f.read()))
+        os.remove(depfile)
+    except OSError:
+        _warning("compiler did not write depfile %s\n" % depfile)
+        return None
+
+    return [p for p in paths if p not in job.inputs]
+
+_MSVC_INCLUDE_PREFIX = 'Note: including file:'
+
+def _is_msvc_system_include(path):
+    lower = path.lower()
+    return 'program files' in lower or 'microsoft visual studio' in lower
+
+def _run_cmd_show_includes(cmd):
+    """run an msvc compile with /showIncludes, stripping the include
+    notes from its output.  returns (exit code, list of headers)"""
+    import subprocess
+    _message(0, cmd)
+    with _TraceSpan('cmd', cmd=cmd):
+        proc = subprocess.Popen(cmd, shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True,
+                                pass_fds=_jobserver['fds'])
+        includes = []
+        seen = set()
+        for line in proc.stdout:
+            if not line.startswith(_MSVC_INCLUDE_PREFIX):
+                sys.stdout.write(line)
+                continue
+
+            path = line[len(_MSVC_INCLUDE_PREFIX):].strip()
+            if path not in seen and not _is_msvc_system_include(path):
+                seen.add(path)
+                includes.append(path)
+
+        return proc.wait(), includes
+
 
 def _run_cmd(cmd):
+    """run a build_this() command, returning its exit code"""
+    import subprocess
     _message(0, cmd)
-    exit_code = subprocess.call(cmd, shell=True)
+    with _TraceSpan('cmd', cmd=cmd):
+        return subprocess.call(cmd, shell=True, pass_fds=_jobserver['fds'])
+
+
+def _run_job(job):
+    """run a job and log it on success, returning its exit code"""
+    # jobs that wait on a rebuilt pch() are hashed once it is built
+    if job.input_hash == None and len(job.outputs) != 0:
+        _hash_job(job)
+
+    cache_key = None
+    if _cfg['cache_dir'] != None:
+        cache_key = _cache_key(job)
+        if cache_key != None:
+            includes = _cache_restore(job, cache_key)
+            if includes != None:
+                _record_job(job, includes)
+                return 0
+
+            # a restored object may be a hard link into the cache.
+            # unlink it so the compiler cannot write through it.
+            for out_path in job.outputs:
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+
+    includes = None
+    start = time.perf_counter()
+    if job.deps == 'msvc':
+        exit_code, includes = _run_cmd_show_includes(job.cmd)
+    else:
+        exit_code = _run_cmd(job.cmd)
+
     if exit_code != 0:
-        _fatal_error("error '%d' running command \"%s\"\n" %
-                     (exit_code, cmd))
+        return exit_code
+    _record_duration(job, time.perf_counter() - start)
+
+    if job.deps == 'gcc':
+        includes = _read_depfile(job)
+
+    if cache_key != None and includes != None:
+        _cache_store(job, cache_key, includes)
+
+    _forget_file_states(job.outputs)
+    _record_job(job, includes)
+    return 0
+
+
+#
+# job scheduling
+#
+# The pool starts the queued job at the head of the longest chain first:
+# its expected duration plus that of the longest chain of jobs waiting
+# on it.  Starting the slowest work first keeps it from being left to
+# run alone at the end of the build.
+#
+# A job is expected to take as long as it did last time, as kept in the
+# build log.  Jobs that never ran are estimated from the size of their
+# input file, at the seconds per byte that the logged jobs took.
+#
+_SECS_PER_BYTE = 2e-5  # estimate when no job has been logged yet
+
+_schedule = {'secs_per_byte': None}
+
+def _duration_key(job):
+    if len(job.outputs) != 0:
+        return job.outputs[0]
+    return job.cmd
+
+def _input_size(job):
+    # the input file, not eg. a pch the job also reads
+    paths = job.inputs
+    if job.source != None:
+        paths = [job.source]
+
+    size = 0
+    for path in paths:
+        try:
+            size += os.stat(path).st_size
+        except OSError:
+            pass
+    return size
+
+def _record_duration(job, secs):
+    """log how long a job's command took, averaged with earlier runs
+    since parallel builds make single timings noisy"""
+    key = _duration_key(job)
+    size = _input_size(job)
+    with _build_log['lock']:
+        last = _build_log['durations'].get(key)
+        if last != None:
+            secs = (secs + last[0]) / 2
+        _build_log['durations'][key] = (secs, size)
+        _build_log['dirty'] = True
+
+def _expected_duration(job):
+    """seconds job is expected to run"""
+    _load_build_log()
+    last = _build_log['durations'].get(_duration_key(job))
+    if last != None:
+        return last[0]
+
+    if _schedule['secs_per_byte'] == None:
+        total_secs = 0.0
+        total_size = 0
+        with _build_log['lock']:
+            for secs, size in _build_log['durations'].values():
+                total_secs += secs
+                total_size += size
+        if total_size != 0:
+            _schedule['secs_per_byte'] = total_secs / total_size
+        else:
+            _schedule['secs_per_byte'] = _SECS_PER_BYTE
+
+    return _input_size(job) * _schedule['secs_per_byte']
+
+
+#
+# object cache
+#
+# Compile jobs are keyed on the compiler binary, the command line with
+# its output paths blanked out, and the preprocessed source.  An entry is
+# the object file plus a list of the headers it included, so header
+# dependencies stay correct on a hit.
+#
+# Entries are written to a temp file and renamed into place, so parallel
+# jobs and other jfdi processes never see a partial object.  A hit bumps
+# the entry's mtime, which is what least-recently-used eviction sorts on.
+#
+_cache_stats = {'lock': _thread.allocate_lock(),
+                'hits': 0,
+                'misses': 0,
+                'added_bytes': 0}
+
+_compiler_ids = {}
+
+def _parse_size(size_str):
+    """'500M' -> 524288000"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size_str = size_str.strip().upper()
+    try:
+        if size_str[-1:] in units:
+            return int(float(size_str[:-1]) * units[size_str[-1]])
+        return int(size_str)
+    except ValueError:
+        _fatal_error("invalid size '%s'.  Use bytes or K, M, G, T\n" %
+                     size_str)
+
+def _compiler_id(exe_name):
+    """string identifying the compiler binary that runs as exe_name"""
+    import shutil
+    if exe_name not in _compiler_ids:
+        path = shutil.which(exe_name)
+        if path == None:
+            _compiler_ids[exe_name] = None
+        else:
+            st = os.stat(path)
+            _compiler_ids[exe_name] = "%s:%d:%d" % \
+                (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    return _compiler_ids[exe_name]
+
+def _preprocess_cmd(job):
+    """command that writes job's preprocessed source to stdout, or None
+    if the job does not look like a single object compile"""
+    out_path = job.outputs[0]
+    tokens = job.cmd.split(' ')
+
+    if job.deps == 'gcc':
+        compile_flag = '-c'
+        drop = ['-MMD', '-MF', _depfile_path(job), '-o', out_path]
+        drop_prefixes = ['-o' + out_path]
+    else:
+        compile_flag = '/c'
+        drop = ['/showIncludes']
+        drop_prefixes = ['/Fo', '-Fo']
+
+    if compile_flag not in tokens:
+        return None
+
+    pp_tokens = []
+    for t in tokens:
+        if t in drop or any(t.startswith(p) for p in drop_prefixes):
+            continue
+        if t == compile_flag:
+            t = compile_flag[0] + 'E'
+        pp_tokens.append(t)
+
+    return ' '.join(pp_tokens)
+
+def _cache_key(job):
+    """hex cache key for a compile job, or None if it is not cacheable"""
+    import hashlib
+    import subprocess
+    if job.deps not in ('gcc', 'msvc') or len(job.outputs) != 1:
+        return None
+
+    compiler = _compiler_id(job.cmd.split(' ', 1)[0])
+    pp_cmd = _preprocess_cmd(job)
+    if compiler == None or pp_cmd == None:
+        return None
+
+    # failures are left for the real compile to report
+    with _TraceSpan('preprocess', cmd=pp_cmd):
+        proc = subprocess.run(pp_cmd, shell=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None
+
+    out_path = job.outputs[0]
+    normalized_cmd = job.cmd.replace(_depfile_path(job), '<depfile>')
+    normalized_cmd = normalized_cmd.replace(out_path, '<out>')
+
+    h = hashlib.blake2b(digest_size=20)
+    for part in (compiler, normalized_cmd):
+        h.update(part.encode('utf-8', 'surrogateescape'))
+        h.update(b'\0')
+    h.update(proc.stdout)
+
+    # a pch is not expanded by the preprocessor, so key on what built it
+    for after in job.after:
+        if after.cmd_hash == None or after.input_hash == None:
+            return None
+        h.update(after.cmd_hash + after.input_hash)
+    return h.hexdigest()
+
+def _cache_entry_path(key):
+    return os.path.join(_cfg['cache_dir'], key[:2], key)
+
+def _cache_restore(job, key):
+    """restore job's output from the cache.  returns the list of
+    headers it included, or None on a miss"""
+    import shutil
+    entry = _cache_entry_path(key)
+    out_path = job.outputs[0]
+    try:
+        with open(entry + '.deps') as f:
+            includes = f.read().splitlines()
+
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        try:
+            os.link(entry + '.obj', out_path)
+        except OSError:
+            shutil.copyfile(entry + '.obj', out_path)
+
+        os.utime(entry + '.obj')
+    except OSError:
+        # missing, or evicted by another process while restoring
+        with _cache_stats['lock']:
+            _cache_stats['misses'] += 1
+        return None
+
+    _message(0, "cached %s" % out_path)
+    with _cache_stats['lock']:
+        _cache_stats['hits'] += 1
+    return includes
+
+def _cache_store(job, key, includes):
+    import shutil
+    import threading
+    entry = _cache_entry_path(key)
+    tmp_suffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # deps first: an .obj without its .deps is never used
+        with open(entry + '.deps' + tmp_suffix, 'w') as f:
+            f.write('\n'.join(includes))
+        os.replace(entry + '.deps' + tmp_suffix, entry + '.deps')
+
+        # copy rather than link, so the cache does not share an inode
+        # with a file the compiler may overwrite in place
+        shutil.copyfile(job.outputs[0], entry + '.obj' + tmp_suffix)
+        os.replace(entry + '.obj' + tmp_suffix, entry + '.obj')
+    except OSError as e:
+        _warning("could not write %s to cache: %s\n" % (job.outputs[0], e))
+        return
+
+    with _cache_stats['lock']:
+        _cache_stats['added_bytes'] += os.path.getsize(entry + '.obj')
+
+class _FileLock:
+    """exclusive lock on a file, held across processes"""
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        # closing releases flock()
+        self.f.close()
+
+def _cache_trim():
+    """account for objects added this run and evict least recently used
+    entries once the cache is over its size limit"""
+    if _cfg['cache_dir'] == None or _cache_stats['added_bytes'] == 0:
+        return
+
+    size_path = os.path.join(_cfg['cache_dir'], 'size')
+    with _FileLock(os.path.join(_cfg['cache_dir'], 'lock')):
+        try:
+            with open(size_path) as f:
+                size = int(f.read())
+        except (OSError, ValueError):
+            size = 0
+
+        size += _cache_stats['added_bytes']
+        _cache_stats['added_bytes'] = 0
+
+        # the running total is only an estimate across processes; a full
+        # scan settles the real size before anything is evicted.
+        if size > _cfg['cache_size']:
+            size = _cache_evict()
+
+        _write_atomic(size_path, str(size).encode('ascii'))
+
+def _cache_evict():
+    entries = []
+    size = 0
+    for sub in os.scandir(_cfg['cache_dir']):
+        if not sub.is_dir():
+            continue
+        for e in os.scandir(sub.path):
+            if not e.name.endswith('.obj'):
+                continue
+            st = e.stat()
+            entries.append((st.st_mtime_ns, st.st_size, e.path))
+            size += st.st_size
+
+    # trim to 90% so eviction does not run on every build
+    target = _cfg['cache_size'] * 9 // 10
+    if size <= target:
+        return size
+
+    entries.sort()
+    num_evicted = 0
+    for mtime, entry_size, path in entries:
+        if size <= target:
+            break
+        for p in (path, path[:-len('.obj')] + '.deps'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        size -= entry_size
+        num_evicted += 1
+
+    _message(1, "evicted %d object(s) from cache" % num_evicted)
+    return size
+
+
+# the pool of the build in progress, if any
+_active_pool = None
+
+# -j bounds build_this() jobs and cmd_async() commands together
+_slots = []
+_slots_lock = _thread.allocate_lock()
+
+def _job_slots():
+    """_JobSlots held while a job or cmd_async() command runs"""
+    if len(_slots) == 0:
+        with _slots_lock:
+            if len(_slots) == 0:
+                _slots.append(_JobSlots(_cfg['jobs']))
+    return _slots[0]
+
+#
+# GNU make jobserver
+#
+# make tells the commands it runs about its jobserver in MAKEFLAGS: a
+# pipe whose fds they inherit (--jobserver-auth=R,W) or a named fifo
+# (--jobserver-auth=fifo:PATH).  Every process may run one job for
+# free.  Each job beyond that needs a one byte token read from the
+# jobserver, written back when the job is done.
+#
+# jfdi's -j slots follow the same protocol, so under make it never runs
+# more jobs than make's -j allows.  Without a jobserver to join, a build
+# creates one holding -j minus one tokens and exports it in MAKEFLAGS,
+# so make, ninja or jfdi started by its commands share jfdi's -j.
+#
+_jobserver = {'read_fd': None,
+              'write_fd': None,
+              'fds': () }    # pipe fds that commands must inherit
+
+def _jobserver_init(serve):
+    """join the jobserver in MAKEFLAGS, or create one if serve is set"""
+    import stat
+    makeflags = os.environ.get('MAKEFLAGS', '')
+    auth = None
+    for word in makeflags.split(' '):
+        # --jobserver-fds is what make called it before 4.2
+        for prefix in ('--jobserver-auth=', '--jobserver-fds='):
+            if word.startswith(prefix):
+                auth = word[len(prefix):]
+
+    if auth == None:
+        if serve and os.name == 'posix' and _cfg['jobs'] > 1:
+            _jobserver_serve(makeflags)
+        return
+
+    if auth.startswith('fifo:'):
+        try:
+            fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+        except OSError as e:
+            _warning("jobserver fifo unavailable: %s; using -j1\n" % e)
+            _cfg['jobs'] = 1
+            return
+        _jobserver['read_fd'] = _jobserver['write_fd'] = fd
+        _message(1, "joined make jobserver %s" % auth)
+        return
+
+    fds = auth.split(',')
+    if len(fds) != 2 or not all(fd.lstrip('-').isdigit() for fd in fds):
+        # eg. the named semaphore make uses on Windows
+        _message(1, "ignoring unsupported jobserver %s" % auth)
+        return
+
+    read_fd, write_fd = int(fds[0]), int(fds[1])
+    try:
+        fifos = all(stat.S_ISFIFO(os.fstat(fd).st_mode)
+                    for fd in (read_fd, write_fd))
+    except (OSError, ValueError):
+        fifos = False
+    if not fifos:
+        # make only passes the fds to recipes it knows run make
+        _warning("jobserver unavailable: using -j1.  " +
+                 "Add '+' to the parent make rule.\n")
+        _cfg['jobs'] = 1
+        return
+
+    _jobserver['read_fd'] = read_fd
+    _jobserver['write_fd'] = write_fd
+    _jobserver['fds'] = (read_fd, write_fd)
+    _message(1, "joined make jobserver %s" % auth)
+
+def _jobserver_serve(makeflags):
+    """create a jobserver pipe with a token for each -j slot but jfdi's
+    own, and export it to commands in MAKEFLAGS"""
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'+' * (_cfg['jobs'] - 1))
+
+    _jobserver['read_fd'] = read_fd
+    _jobserver['write_fd'] = write_fd
+    _jobserver['fds'] = (read_fd, write_fd)
+    os.environ['MAKEFLAGS'] = ('%s -j%d --jobserver-auth=%d,%d' %
+                               (makeflags, _cfg['jobs'], read_fd,
+                                write_fd)).strip()
+    _message(1, "jobserver: %s" % os.environ['MAKEFLAGS'])
+
+def _jobserver_read():
+    """read a token, waiting for one although make may have made the
+    pipe non-blocking"""
+    import select
+    while True:
+        try:
+            return os.read(_jobserver['read_fd'], 1)
+        except BlockingIOError:
+            # another process may take the token first, so read again
+            select.select([_jobserver['read_fd']], [], [])
+
+class _JobSlots:
+    """-j slots.  A slot beyond the first also takes a jobserver token,
+    if there is a jobserver."""
+    def __init__(self, num_jobs):
+        import threading
+        self.local = threading.Semaphore(max(1, num_jobs))
+        self.lock = threading.Lock()
+        self.own_free = True  # the slot that needs no token
+        self.tokens = []      # read from the jobserver, to be written back
+
+    def __enter__(self):
+        self.local.acquire()
+        if _jobserver['read_fd'] == None:
+            return self
+
+        with self.lock:
+            if self.own_free:
+                self.own_free = False
+                return self
+
+        try:
+            token = _jobserver_read()
+        except BaseException:
+            self.local.release()
+            raise
+        with self.lock:
+            self.tokens.append(token)
+        return self
+
+    def __exit__(self, *exc_info):
+        if _jobserver['read_fd'] != None:
+            token = None
+            with self.lock:
+                if len(self.tokens) != 0:
+                    token = self.tokens.pop()
+                else:
+                    self.own_free = True
+            # a token is returned as soon as possible, whichever slot
+            # it was taken for
+            if token != None:
+                os.write(_jobserver['write_fd'], token)
+        self.local.release()
+
+class _JobPool:
+    """run build commands on a bounded number of worker threads.
+
+    Queued jobs start in order of priority, see _expected_duration().  A
+    job whose after jobs have not finished is held back until they do.
+    The first command to fail stops any queued commands from starting.
+    Commands that are already running are allowed to finish, then wait()
+    reports every command that failed and exits.
+    """
+    def __init__(self, num_workers):
+        import threading
+        self.num_workers = max(1, num_workers)
+        self.queue = []      # heap of (-priority, submit order, job)
+        self.num_submitted = 0
+        self.blocked = []    # jobs waiting on their after jobs
+        self.cv = threading.Condition()
+        self.threads = []
+        self.running = 0
+        self.closed = False
+        self.failures = []   # (exit_code, job) of each failed command
+
+    def has_failed(self):
+        with self.cv:
+            return len(self.failures) != 0
+
+    def submit(self, job):
+        job.cost = _expected_duration(job)
+        job.priority = job.cost
+        with self.cv:
+            if len(self.failures) != 0:
+                return
+            self._weigh_after(job)
+            if all(a.finished for a in job.after):
+                self._push(job)
+                self._spawn_worker()
+                self.cv.notify()
+            else:
+                self.blocked.append(job)
+
+    def _push(self, job):
+        """queue a job that is ready to run.  call with cv held"""
+        import heapq
+        self.num_submitted += 1
+        heapq.heappush(self.queue, (-job.priority, self.num_submitted, job))
+
+    def _weigh_after(self, job):
+        """raise the priority of the jobs that job waits on, so the
+        longest chain through them starts first.  call with cv held"""
+        import heapq
+        raised = False
+        stack = [job]
+        while len(stack) != 0:
+            waiting = stack.pop()
+            for a in waiting.after:
+                weight = a.cost + waiting.priority
+                if a.finished or weight <= a.priority:
+                    continue
+                a.priority = weight
+                raised = True
+                stack.append(a)
+
+        if raised and len(self.queue) != 0:
+            self.queue = [(-j.priority, n, j) for _, n, j in self.queue]
+            heapq.heapify(self.queue)
+
+    def _spawn_worker(self):
+        """spawn workers lazily, never more than there is work for.  call
+        with cv held"""
+        import threading
+        if len(self.threads) < self.num_workers and \
+           len(self.threads) < len(self.queue) + self.running:
+            t = threading.Thread(target=self._worker,
+                                 args=(len(self.threads) + 1,),
+                                 daemon=True)
+            self.threads.append(t)
+            t.start()
+
+    def _worker(self, worker_num):
+        import heapq
+        _trace_thread_name("job worker %d" % worker_num)
+        while True:
+            with self.cv:
+                while len(self.queue) == 0 and \
+                      (not self.closed or len(self.blocked) != 0):
+                    self.cv.wait()
+
+                if len(self.queue) == 0:
+                    return
+
+                job = heapq.heappop(self.queue)[2]
+                self.running += 1
+
+            _current.ns = job.ns
+            exit_code = 1
+            try:
+                with _job_slots():
+                    # a job that failed while this one waited for a slot,
+                    # eg. a make token, cancels it like the queued ones
+                    if self.has_failed():
+                        exit_code = 0
+                    else:
+                        exit_code = _run_job(job)
+            except SystemExit as e:
+                # a _fatal_error(), which has reported itself
+                exit_code = e.code if e.code.__class__ == int else 1
+            except BaseException as e:
+                # reported by wait() in place of an exit code
+                exit_code = e
+            finally:
+                with self.cv:
+                    self.running -= 1
+                    job.finished = True
+                    if exit_code != 0:
+                        self.failures.append((exit_code, job))
+                        # cancel everything that has not started yet
+                        self.queue.clear()
+                        self.blocked = []
+                    elif len(self.blocked) != 0:
+                        self._release_blocked()
+                    self.cv.notify_all()
+
+    def _release_blocked(self):
+        """queue the blocked jobs that are now ready.  call with cv held"""
+        still_blocked = []
+        for job in self.blocked:
+            if all(a.finished for a in job.after):
+                self._push(job)
+            else:
+                still_blocked.append(job)
+        self.blocked = still_blocked
+        for _ in range(len(self.queue)):
+            self._spawn_worker()
+
+    def wait_for(self, job):
+        """block until a submitted job has finished or was cancelled"""
+        with self.cv:
+            while not job.finished and len(self.failures) == 0:
+                self.cv.wait(0.25)
+
+    def wait(self):
+        """block until every submitted command finished.  fatal on failure"""
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+            while len(self.queue) != 0 or self.running != 0 or \
+                  len(self.blocked) != 0:
+                # timeout keeps the main thread responsive to ctrl-c
+                self.cv.wait(0.25)
+
+        for t in self.threads:
+            t.join()
+
+        if len(self.failures) != 0:
+            msg = ''
+            for exit_code, job in self.failures:
+                if exit_code.__class__ == int:
+                    msg += "error '%d' running command \"%s\"" % \
+                           (exit_code, job.cmd)
+                else:
+                    msg += "%s: %s running command \"%s\"" % \
+                           (exit_code.__class__.__name__, exit_code, job.cmd)
+                if job.source != None:
+                    msg += " for %s" % job.source
+                msg += "\n"
+            _fatal_error(msg)
+
+#
+# --trace
+#
+# Spans are recorded as Chrome trace-event "complete" events and written
+# as JSON when jfdi exits, including when it exits with an error.  Each
+# job worker gets its own track so parallelism is visible in Perfetto.
+#
+_trace = {'events': None,   # list of events once tracing is on
+          'path': None,
+          'lock': _thread.allocate_lock(),
+          'tids': {},       # thread ident -> track id
+          'names': {} }     # track name -> track id
+
+def _start_trace(path):
+    import atexit
+    _trace['events'] = []
+    _trace['path'] = path
+    _trace_thread_name('main')
+    atexit.register(_write_trace)
+
+def _trace_thread_name(name):
+    """put spans from the calling thread on the track called name"""
+    if _trace['events'] == None:
+        return
+
+    with _trace['lock']:
+        tid = _trace['names'].get(name)
+        if tid == None:
+            tid = len(_trace['names'])
+            _trace['names'][name] = tid
+            _trace['events'].append({'name': 'thread_name', 'ph': 'M',
+                                     'pid': 1, 'tid': tid,
+                                     'args': {'name': name}})
+        _trace['tids'][_thread.get_ident()] = tid
+
+def _write_trace():
+    import json
+    with _trace['lock']:
+        data = {'traceEvents': _trace['events'],
+                'displayTimeUnit': 'ms'}
+        with open(_trace['path'], 'w') as f:
+            json.dump(data, f)
+
+class _TraceSpan:
+    """with _TraceSpan('name', key=value): records a span for --trace.
+    Costs one comparison when tracing is off."""
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        if _trace['events'] != None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start == None:
+            return
+        end = time.perf_counter()
+
+        with _trace['lock']:
+            tid = _trace['tids'].get(_thread.get_ident(), 0)
+            _trace['events'].append(
+                {'name': self.name, 'cat': 'jfdi', 'ph': 'X',
+                 'pid': 1, 'tid': tid,
+                 'ts': (self.start - g_start_perf) * 1e6,
+                 'dur': (end - self.start) * 1e6,
+                 'args': self.args})
+
 
 def _report_success(start_time):
+    if _cfg['cache_dir'] != None:
+        hits = _cache_stats['hits']
+        total = hits + _cache_stats['misses']
+        if total != 0:
+            _message(0, "cache: %d hit(s), %d miss(es), %d%% hit rate" %
+                     (hits, total - hits, hits * 100 // total))
+
     end_time = time.time()
     delta_time = end_time - start_time
     _message(0, "exiting with success in %.1f seconds." % delta_time)
@@ -494,12 +2830,18 @@ def _log_stamp():
     d_ms = int((cur_time - g_start_time) * 1000)
 
     if d_ms < 1000:
-        return "[%s ms]" % str(d_ms).rjust(justify_chars-2)
+        stamp = "[%s ms]" % str(d_ms).rjust(justify_chars-2)
     else:
         d_s = cur_time - g_start_time
 
         num = "%.1f" % d_s
-        return "[%ss]" % num.rjust(justify_chars)
+        stamp = "[%ss]" % num.rjust(justify_chars)
+
+    # output of concurrent --variants builds is interleaved
+    variant = _ns()['_variant']
+    if variant != None:
+        stamp += " [%s]" % variant
+    return stamp
 
 def _display_help_topic(topic):
     if topic == 'buildvars':
@@ -526,6 +2868,16 @@ Corresponding buildvar code:
  if yes('debug'):
     CFLAGS.append('-g')
 
+ REGARDING VARIANTS:
+ - --variants builds each setting as its own variant, concurrently.
+   Each variant runs the build script with its own globals, so
+   variants must write to different output paths.
+ - Repeat --variants to build every combination.  TARGET_OS=value
+   sets TARGET_OS rather than a build var.
+
+Example variants usage:
+ jfdi --variants DEBUG=0,DEBUG=1 --variants TARGET_OS=Linux,TARGET_OS=Windows
+
 '''
 
     else:
@@ -557,10 +2909,21 @@ jfdi build script
 
 available functions:
   cp(src, dst)  - copy a file or directory
+                  cp(src, dst, sync=True) only copies files that changed.
+                  delete=True removes files not in src, link=True hardlinks
   rm(str|iter)  - remove file or directory
+                  rm(d, background=True) deletes directories after jfdi exits
   arg(str)      - convert a /flag into a -flag depending on compiler
   use('?')      - add make-like variables (LD, CC, etc.). gcc, clang, msvc
+                  options: linker='lld'|'mold'|'gold', split_dwarf=True,
+                  incremental=True (msvc), lto_cache='dir' (clang ThinLTO),
+                  lto_cache_size='1G'
   cmd(list|str) - run a command on a shell, fatal if error, stdout returns as str
+                  cmd(c, stream=True) prints output as it arrives, keeping
+                  the last tail=N lines.  tee='file' also logs to file
+  cmd_async(c)  - start a command on -j jobs, returning a future whose
+                  .result() waits and returns stdout.  wait_all() waits for
+                  every command started, fatal if any failed
   die(str)      - fail build with a message, errorlevel 3
   env(str)      - return environment variable or None
   exe(str)      - return filename with exe extension based on TARGET_OS
@@ -568,9 +2931,15 @@ available functions:
   exp(str)      - expand a $string, searching CLI --vars and then global scope
   ext(str)      - return file extension         (file.c = .c)
   raw(str)      - return file without extension (file.c = file)
+  job(cmd,i,o)  - return cmd for build_this() that is skipped if outputs o
+                  are newer than inputs i (i defaults to in_path).
+                  $CC/$CXX commands also track the headers they include
   log(str)      - print to stdout
   mkd(str)      - make all subdirs
+  new(src,dst)  - true if file src is newer than file dst
   obj(str)      - return filename with obj file ext (file.c = file.obj)
+  pch(str)      - precompile a header and add it to CFLAGS (CXXFLAGS with
+                  cxx=True).  returns objects to link, if any (msvc)
   pth(str)      - swap path slashes -- \ on windows, / otherwise
   var(str)      - get buildvar passed in as a string, ie: DEBUG="0"
   yes(str)      - get buildvar passed in as a boolean, ie: DEBUG=False
@@ -602,7 +2971,9 @@ def list_input_files():
     return []
 
 
-# return command to build single file in_path or None to skip
+# return command to build single file in_path or None to skip.
+# return job(command, in_path, out_path) to skip when out_path is up to date.
+# return a list of commands or jobs to run several in parallel.
 def build_this(in_path):
     return None
 
@@ -666,25 +3037,32 @@ def _api_log(msg):
     frame = sys._getframe(1)
     func_name = frame.f_code.co_name
     
-    print("%s %s(): %s" % (_log_stamp(), func_name, msg))
+    _write_line(sys.stdout, "%s %s(): %s\n" % (_log_stamp(), func_name, msg))
 
 def _api_mkd(dirs):
     dirs = _swap_slashes(dirs)
     _message(1, "making dirs %s" % dirs)
     os.makedirs(dirs, exist_ok=True)
 
-def _api_cmd(cmd):
+def _api_cmd(cmd, stream=False, tail=1000, tee=None):
+    import subprocess
     if cmd.__class__ == list:
         cmd_str = ' '.join(cmd)
     else:
         cmd_str = cmd
 
     _message(0, cmd_str)
+    _wait_for_pch(cmd_str)
 
-    proc = subprocess.Popen(cmd_str, shell=True,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+    if stream or tee != None:
+        return _stream_cmd(cmd_str, tail, tee)
+
+    with _TraceSpan('cmd', cmd=cmd_str):
+        proc = subprocess.Popen(cmd_str, shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                pass_fds=_jobserver['fds'])
+        out, err = proc.communicate()
     ret = proc.returncode
 
     if len(err) != 0:
@@ -698,7 +3076,190 @@ def _api_cmd(cmd):
 
     return out.rstrip().decode('utf-8')
 
-def _api_cp(src, dst):
+#
+# cmd_async()
+#
+# Commands run on a thread pool and take a -j slot while running, so
+# they share the limit with build_this() jobs.  As in the job pool, the
+# first failure stops commands that have not started yet, and wait_all()
+# reports every failure.  jfdi calls wait_all() after end_build(),
+# clean() and run(), so no failure goes unreported.
+#
+_async = {'lock': _thread.allocate_lock(),
+          'executor': None,
+          'pending': [],     # _AsyncCmds not yet waited on
+          'failed': False }
+
+class _AsyncCmd:
+    """a command started by cmd_async()"""
+    def __init__(self, cmd_str):
+        self.cmd = cmd_str
+        self.future = None
+        self.exit_code = None  # stays None if cancelled by a failure
+        self.out = ''
+        self.err = ''
+
+    def done(self):
+        """true once the command finished or was cancelled"""
+        return self.future.done()
+
+    def result(self):
+        """wait for the command and return its stdout, like cmd().  fatal
+        if it or an earlier command failed"""
+        self.future.result()
+        if self.exit_code != 0:
+            _api_wait_all()
+        return self.out
+
+    def __str__(self):
+        return self.result()
+
+def _api_cmd_async(cmd):
+    import concurrent.futures
+    cmd_str = ' '.join(cmd) if cmd.__class__ == list else cmd
+    c = _AsyncCmd(cmd_str)
+
+    with _async['lock']:
+        if _async['executor'] == None:
+            _async['executor'] = concurrent.futures.ThreadPoolExecutor(
+                max(1, _cfg['jobs']), thread_name_prefix='cmd_async')
+        c.future = _async['executor'].submit(_run_async, c)
+        _async['pending'].append(c)
+    return c
+
+def _run_async(c):
+    import subprocess
+    import threading
+    _trace_thread_name(threading.current_thread().name)
+    with _job_slots():
+        if _async['failed']:
+            return
+
+        _message(0, c.cmd)
+        with _TraceSpan('cmd', cmd=c.cmd):
+            proc = subprocess.run(c.cmd, shell=True,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  pass_fds=_jobserver['fds'])
+
+    c.out = proc.stdout.rstrip().decode('utf-8', errors='replace')
+    c.err = proc.stderr.rstrip().decode('utf-8', errors='replace')
+    c.exit_code = proc.returncode
+    if c.exit_code != 0:
+        _async['failed'] = True
+    elif len(c.err) != 0:
+        _warning(c.err + '\n')
+
+def _api_wait_all():
+    """wait for every cmd_async() command, returning their stdout in the
+    order they were started.  fatal if any failed"""
+    with _async['lock']:
+        pending = _async['pending']
+        _async['pending'] = []
+
+    for c in pending:
+        c.future.result()
+
+    # commands started from now on run again, eg. in the next watch build
+    _async['failed'] = False
+
+    failures = [c for c in pending
+                if c.exit_code != None and c.exit_code != 0]
+    if len(failures) == 0:
+        return [c.out for c in pending]
+
+    msg = ''
+    for c in failures:
+        if len(c.out) != 0:
+            print(c.out, file=sys.stdout)
+        if len(c.err) != 0:
+            print(c.err, file=sys.stderr)
+        msg += "error '%d' running command \"%s\"\n" % (c.exit_code, c.cmd)
+    _fatal_error(msg, error_code=failures[0].exit_code)
+
+_STREAM_MAX_LINE = 64 * 1024
+
+def _stream_cmd(cmd_str, tail, tee_path):
+    """cmd() that forwards output as it arrives instead of buffering it.
+
+    Only the last tail lines of stdout are kept, for the return value, and
+    the last tail lines of stderr, for the failure report.  Everything is
+    appended to tee_path if it is set.
+    """
+    import threading
+    import subprocess
+    import collections
+
+    tee = None
+    if tee_path != None:
+        tee = open(tee_path, 'ab')
+    tee_lock = threading.Lock()
+
+    def pump(pipe, dst, kept):
+        # forward whatever has arrived, then split it into lines for the
+        # tail.  a partial line is capped so memory stays bounded even if
+        # the line never ends.
+        partial = b''
+        while True:
+            chunk = os.read(pipe.fileno(), 64 * 1024)
+            if len(chunk) == 0:
+                break
+
+            dst.write(chunk)
+            dst.flush()
+            if tee != None:
+                with tee_lock:
+                    tee.write(chunk)
+
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()[-_STREAM_MAX_LINE:]
+            kept.extend(line + b'\n' for line in lines)
+
+        if len(partial) != 0:
+            kept.append(partial)
+
+    out_tail = collections.deque(maxlen=tail)
+    err_tail = collections.deque(maxlen=tail)
+
+    # keep jfdi's own buffered messages ahead of the child's output
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    with _TraceSpan('cmd', cmd=cmd_str):
+        proc = subprocess.Popen(cmd_str, shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                pass_fds=_jobserver['fds'])
+        err_thread = threading.Thread(target=pump,
+                                      args=(proc.stderr, sys.stderr.buffer,
+                                            err_tail),
+                                      daemon=True)
+        err_thread.start()
+        pump(proc.stdout, sys.stdout.buffer, out_tail)
+        err_thread.join()
+        ret = proc.wait()
+
+    if tee != None:
+        tee.close()
+
+    if ret != 0:
+        if len(err_tail) != 0:
+            sys.stderr.write("last %d line(s) of stderr:\n" % len(err_tail))
+            sys.stderr.write(b''.join(err_tail).decode('utf-8',
+                                                       errors='replace'))
+        msg = "\nerror code %d running \"%s\"\n" % (ret, cmd_str)
+        if tee_path != None:
+            msg += "full output is in %s\n" % tee_path
+        _fatal_error(msg, error_code=ret)
+
+    return b''.join(out_tail).rstrip().decode('utf-8', errors='replace')
+
+def _api_cp(src, dst, sync=False, delete=False, link=False):
+    import shutil
+    if sync:
+        _sync(src, dst, delete, link)
+        return
+
     if os.path.isdir(src):
         _message(0, "recursively copy %s to %s" % (src, dst))
         shutil.copytree(src, dst)
@@ -706,34 +3267,261 @@ def _api_cp(src, dst):
         _message(0, "cp %s to %s" % (src, dst))
         shutil.copy2(src, dst)
 
+def _sync(src, dst, delete, link):
+    """make dst a copy of src, copying only files whose size or mtime
+    differ on a pool of threads"""
+    import concurrent.futures
+    import shutil
+
+    copies = []   # (src, dst) of each file to copy
+    num_files = 0
+    num_removed = 0
+
+    def remove(path, is_dir):
+        if is_dir:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    try:
+        stack = []
+        if os.path.isdir(src):
+            stack.append((src, dst))
+        else:
+            # into a directory, as copy2() does
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            num_files = 1
+            if _sync_differs(os.stat(src), dst):
+                copies.append((src, dst))
+
+        while len(stack) != 0:
+            src_dir, dst_dir = stack.pop()
+            os.makedirs(dst_dir, exist_ok=True)
+            dst_entries = {e.name: e for e in os.scandir(dst_dir)}
+
+            for e in os.scandir(src_dir):
+                src_path = os.path.join(src_dir, e.name)
+                dst_path = os.path.join(dst_dir, e.name)
+                old = dst_entries.pop(e.name, None)
+
+                # a file replaced by a directory, or the reverse.  a
+                # symlink in dst is replaced, not followed.
+                if old != None and \
+                   old.is_dir(follow_symlinks=False) != e.is_dir():
+                    remove(dst_path, old.is_dir(follow_symlinks=False))
+                    old = None
+
+                if e.is_dir():
+                    stack.append((src_path, dst_path))
+                    continue
+
+                # a file hardlinked by an earlier sync(link=True) is
+                # unlinked from src by copying it again
+                num_files += 1
+                if old == None or _sync_differs(e.stat(), old) or \
+                   (not link and old.inode() == e.inode() and
+                    old.stat().st_dev == e.stat().st_dev):
+                    copies.append((src_path, dst_path))
+
+            if delete:
+                for name, old in dst_entries.items():
+                    _message(1, "rm stale %s" % os.path.join(dst_dir, name))
+                    remove(os.path.join(dst_dir, name),
+                           old.is_dir(follow_symlinks=False))
+                    num_removed += 1
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max(1, _cfg['jobs'])) as pool:
+            for _ in pool.map(lambda c: _sync_file(c[0], c[1], link),
+                              copies):
+                pass
+
+    except OSError as e:
+        _fatal_error("cp(): %s\n" % e)
+
+    _message(0, "sync %s to %s: copied %d of %d file(s)" %
+             (src, dst, len(copies), num_files) +
+             (", removed %d" % num_removed if delete else ""))
+
+def _sync_differs(src_stat, dst):
+    """true if dst, a path or a DirEntry, needs to be copied again.
+
+    mtimes are compared to the second, like rsync, since copies on some
+    network and FAT filesystems do not keep nanoseconds.
+    """
+    try:
+        dst_stat = dst.stat() if not isinstance(dst, str) else os.stat(dst)
+    except OSError:
+        return True
+    return dst_stat.st_size != src_stat.st_size or \
+        dst_stat.st_mtime_ns // 1000000000 != \
+        src_stat.st_mtime_ns // 1000000000
+
+def _sync_file(src, dst, link):
+    import shutil
+    _message(1, "cp %s to %s" % (src, dst))
+
+    # never write through dst, which may be a hardlink to src
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # another filesystem, or no hardlinks: copy instead
+
+    if not _copy_file_fast(src, dst):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+_FICLONE = 0x40049409
+
+def _copy_file_fast(src, dst):
+    """copy src to dst by sharing its blocks (reflink) or in the kernel
+    with copy_file_range().  false if neither is supported"""
+    if not hasattr(os, 'copy_file_range'):
+        return False
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30)
+                if n == 0:
+                    return True
+                copied += n
+        except OSError:
+            # eg. EXDEV across filesystems on older kernels
+            if copied != 0:
+                raise
+            return False
+
 def _api_die(msg):
     sys.stderr.write("die: " + msg + "\n")
     sys.exit(3)
 
-def _api_rm(files):
+def _api_rm(files, background=False):
+    import concurrent.futures
 
-    file_list = _str_to_list(files)
+    by_norm = {}
+    for f in _str_to_list(files):
+        f = _swap_slashes(f)
+        by_norm.setdefault(os.path.normpath(os.path.abspath(f)), f)
+
+    # paths inside a directory that is also being removed go with it
+    paths = []
+    for norm, f in by_norm.items():
+        parent = os.path.dirname(norm)
+        while parent not in by_norm and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+        if parent not in by_norm:
+            paths.append(f)
+
+    # each thread removes every nth path, one syscall per file
+    num_threads = min(len(paths), max(4, _cfg['jobs']))
+    def rm_some(i):
+        return [(p, _rm_path(p, background))
+                for p in paths[i::num_threads]]
+
+    removed = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, num_threads)) as pool:
+        try:
+            for some in pool.map(rm_some, range(num_threads)):
+                removed += [r for r in some if r[1] != None]
+        except OSError as e:
+            _fatal_error("rm(): %s\n" % e)
+
+    if len(removed) == 1:
+        path, kind = removed[0]
+        _message(0, "%s %s" % ('rm' if kind == 'file' else 'rmdir', path))
+    elif len(removed) != 0:
+        num_dirs = sum(1 for r in removed if r[1] == 'dir')
+        _message(0, "rm %d file(s), %d dir(s)" %
+                 (len(removed) - num_dirs, num_dirs) +
+                 (" (dirs deleted in the background)"
+                  if background and num_dirs != 0 else ""))
+
+def _rm_path(path, background):
+    """remove a file or directory tree.  returns 'file', 'dir', or None if
+    path does not exist"""
+    import shutil
+    # try the common case first: one syscall for a file
+    try:
+        os.remove(path)
+        _message(1, "rm %s" % path)
+        return 'file'
+    except FileNotFoundError:
+        _message(1, "rm nonexistent %s" % path)
+        return None
+    except OSError:
+        if not os.path.isdir(path) or os.path.islink(path):
+            raise
+
+    _message(1, "rmdir %s" % path)
+    if background and _rm_background(path):
+        return 'dir'
+    shutil.rmtree(path, ignore_errors=False)
+    return 'dir'
+
+_rm_trash_lock = _thread.allocate_lock()
+_rm_trash_count = [0]
+
+def _rm_background(path):
+    """rename path out of the way, then delete it from a detached process
+    that outlives jfdi.  false if path could not be renamed (eg. a file in
+    it is open on windows)"""
+    import subprocess
+    with _rm_trash_lock:
+        _rm_trash_count[0] += 1
+        n = _rm_trash_count[0]
+
+    parent, name = os.path.split(os.path.normpath(path))
+    trash = os.path.join(parent, '.%s.jfdi-rm-%d-%d' % (name, os.getpid(), n))
+    try:
+        os.rename(path, trash)
+    except OSError:
+        return False
 
-    for f in file_list:
-        if not os.path.exists(f):
-            _message(1, "rm nonexistent %s" % f)
-            continue
+    kwargs = {}
+    if _host_os() == 'Windows':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | \
+                                  subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    subprocess.Popen([sys.executable, '-c',
+                      'import shutil, sys; shutil.rmtree(sys.argv[1], True)',
+                      trash],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, **kwargs)
+    return True
 
-        f = _swap_slashes(f)
-    
-        if os.path.isdir(f):
-            _message(0, "rmdir %s" % f)
-            shutil.rmtree(f, ignore_errors=False)
-        else:
-            _message(0, "rm %s" % f)
-            os.remove(f)
+def _api_job(cmd, inputs=None, outputs=None, deps=None):
+    return _Job(cmd, inputs, outputs, deps)
+
+def _api_new(src, dst):
+    if not os.path.exists(dst):
+        return True
+    return os.stat(src).st_mtime_ns > os.stat(dst).st_mtime_ns
 
 def _api_env(e):
     if e not in os.environ:
         return None
     return os.environ[e]
 
-def _api_use(id):
+def _api_use(id, linker=None, split_dwarf=False, incremental=False,
+             lto_cache=None, lto_cache_size='1G'):
     v = {}
     if id[:4] == 'msvc':
         v['CC'] = 'cl.exe'
@@ -777,25 +3565,327 @@ def _api_use(id):
         if potential_env in os.environ:
             v[potential_env] = os.environ[potential_env]
 
-    if _which(v['CC']) == None:
+    tc = _probe_toolchain(id, v['CC'], v['LD'])
+
+    if tc['cc_path'] == None:
         _warning("use(): compiler '%s' not found in search path.\n" % v['CC'])
 
-    if _which(v['LD']) == None:
+    if tc['ld_path'] == None:
         _warning("use(): linker '%s' not found in search path.\n" % v['LD'])
 
-    g = globals()
+    g = _ns()
     for var in v:
         g[var] = v[var]
 
+    if linker != None:
+        _use_linker(linker)
+    if split_dwarf:
+        _use_split_dwarf()
+    if incremental:
+        _use_incremental()
+    if lto_cache != None:
+        _use_lto_cache(lto_cache, _parse_size(lto_cache_size))
+
+#
+# use() options
+#
+# Each option is probed with _cc_supports(), whose answer is kept in the
+# toolchain cache, and is left out with a warning if the toolchain does
+# not support it.  The build still works, just more slowly.
+#
+_LINKERS = ('lld', 'mold', 'gold')
+
+def _add_flags(var, flags):
+    """append flags to a flags variable, which the environment may have
+    set to a string"""
+    g = _ns()
+    if g[var].__class__ == str:
+        g[var] = ' '.join([g[var]] + flags).strip()
+    else:
+        g[var] = g[var] + flags
+
+def _use_linker(linker):
+    if linker not in _LINKERS:
+        _fatal_error("use(): unknown linker '%s'.  Use one of: %s\n" %
+                     (linker, ', '.join(_LINKERS)))
+
+    g = _ns()
+    if g['CCTYPE'] == 'msvc':
+        # lld is the only drop-in replacement for link.exe
+        if linker == 'lld' and _tool_found('lld-link.exe'):
+            g['LD'] = 'lld-link.exe'
+            return
+        _warning("use(): linker '%s' not available with %s; " %
+                 (linker, g['CC']) + "using %s\n" % g['LD'])
+        return
+
+    flag = '-fuse-ld=' + linker
+    if not _cc_supports(flag, link=True):
+        _warning("use(): %s cannot link with %s; using its default linker\n" %
+                 (g['CC'], linker))
+        return
+    _add_flags('LDFLAGS', [flag])
+
+def _use_split_dwarf():
+    g = _ns()
+    if g['CCTYPE'] == 'msvc':
+        _warning("use(): split_dwarf does not apply to msvc, " +
+                 "which always writes debug info to a .pdb\n")
+        return
+
+    if not _cc_supports('-gsplit-dwarf'):
+        _warning("use(): %s does not support -gsplit-dwarf\n" % g['CC'])
+        return
+    _add_flags('CFLAGS', ['-g', '-gsplit-dwarf'])
+    _add_flags('CXXFLAGS', ['-g', '-gsplit-dwarf'])
+
+def _use_incremental():
+    g = _ns()
+    if g['CCTYPE'] != 'msvc':
+        _warning("use(): incremental linking is only supported with msvc\n")
+        return
+
+    if not _cc_supports('/INCREMENTAL', link=True):
+        _warning("use(): %s does not support /INCREMENTAL\n" % g['LD'])
+        return
+    _add_flags('LDFLAGS', ['/INCREMENTAL'])
+
+def _use_lto_cache(cache_dir, cache_size):
+    """enable ThinLTO with its cache in cache_dir, pruned to cache_size
+    bytes by the linker.  clang only: cl.exe objects are not bitcode"""
+    g = _ns()
+    cache_dir = os.path.abspath(cache_dir)
+    policy = 'cache_size_bytes=%d' % cache_size
+
+    ld_flags = None
+    if g['CCTYPE'] != 'msvc' and \
+       (g['_toolchain'].get('id') == 'clang' or
+        'clang' in os.path.basename(g['CC'].split(' ')[0])):
+        ld_flags = ['-flto=thin']
+        if '-fuse-ld=gold' in g['LDFLAGS']:
+            ld_flags += ['-Wl,-plugin-opt,cache-dir=' + cache_dir,
+                         '-Wl,-plugin-opt,cache-policy=' + policy]
+        elif _host_os() == 'Darwin':
+            ld_flags += ['-Wl,-cache_path_lto,' + cache_dir]
+        else:
+            # lld and mold
+            ld_flags += ['-Wl,--thinlto-cache-dir=' + cache_dir,
+                         '-Wl,--thinlto-cache-policy=' + policy]
+
+    if ld_flags == None:
+        _warning("use(): %s has no ThinLTO cache; lto_cache ignored\n" %
+                 g['LD'])
+        return
+
+    probe = ' '.join([f for f in g['LDFLAGS'] if f.startswith('-fuse-ld=')] +
+                     ld_flags)
+    if not _cc_supports('-flto=thin'):
+        _warning("use(): %s does not support -flto=thin; " % g['CC'] +
+                 "lto_cache ignored\n")
+        return
+    if not _cc_supports(probe, link=True):
+        _warning("use(): %s cannot use a ThinLTO cache; " % g['LD'] +
+                 "lto_cache ignored\n")
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    _add_flags('CFLAGS', ['-flto=thin'])
+    _add_flags('CXXFLAGS', ['-flto=thin'])
+    _add_flags('LDFLAGS', ld_flags)
+
+def _tool_found(exe_name):
+    """true if exe_name is on PATH, cached with the toolchain"""
+    tc = _ns()['_toolchain']
+    key = 'which ' + exe_name
+    if key not in tc.get('flags', {}):
+        found = _which(exe_name) != None
+        if 'flags' not in tc:
+            return found
+        with _toolchain_cache['lock']:
+            tc['flags'][key] = found
+        _save_toolchain_cache()
+    return tc['flags'][key]
+
+#
+# toolchain probe cache
+#
+# use() resolves the compiler and linker on PATH and asks the compiler
+# for its version.  Later features ask whether it accepts a flag.  The
+# answers are kept in .jfdi/toolchain, keyed on the use() id, CC, LD and
+# PATH.  An entry is reused while both binaries keep their mtimes, so
+# repeat use() calls cost two stat()s.
+#
+_TOOLCHAIN_VERSION = 1
+
+_toolchain_cache = {'loaded': False,
+                    'lock': _thread.allocate_lock(),
+                    'entries': {} }  # key -> toolchain dict
+
+# what the most recent use() resolved to, see _probe_toolchain().  each
+# --variants script namespace has its own.
+_toolchain = {}
+
+def _toolchain_cache_path():
+    return os.path.join(_cfg['state_dir'], 'toolchain')
+
+def _load_toolchain_cache():
+    if _toolchain_cache['loaded']:
+        return
+    _toolchain_cache['loaded'] = True
+
+    try:
+        with open(_toolchain_cache_path(), 'rb') as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+
+    if data.__class__ != dict or data.get('version') != _TOOLCHAIN_VERSION:
+        return
+
+    _toolchain_cache['entries'] = data['entries']
+
+def _save_toolchain_cache():
+    with _toolchain_cache['lock']:
+        data = {'version': _TOOLCHAIN_VERSION,
+                'entries': _toolchain_cache['entries']}
+        try:
+            _write_atomic(_toolchain_cache_path(), marshal.dumps(data))
+        except OSError as e:
+            _message(1, "could not save toolchain cache: %s" % e)
+
+def _mtime_or_none(path):
+    if path == None:
+        return None
+    try:
+        return os.stat(_api_exe(path)).st_mtime_ns
+    except OSError:
+        return None
+
+def _probe_toolchain(id, cc, ld):
+    """resolve cc and ld on PATH and probe the compiler version, or reuse
+    the answer from the toolchain cache.  returns a dict:
+
+      id       - the use() id
+      cc, ld   - the commands as use() set CC and LD
+      cc_path  - absolute path of cc, or None if not found
+      ld_path  - absolute path of ld, or None if not found
+      version  - first line the compiler prints about itself
+      flags    - flag -> true if the compiler accepts it, see _cc_supports()
+    """
+    g = _ns()
+    _load_toolchain_cache()
+    key = '\0'.join((id, cc, ld, os.environ.get('PATH', '')))
+
+    tc = _toolchain_cache['entries'].get(key)
+    if tc != None and tc['cc_mtime'] != None and \
+       tc['cc_mtime'] == _mtime_or_none(tc['cc_path']) and \
+       tc['ld_mtime'] == _mtime_or_none(tc['ld_path']):
+        _message(1, "use(): %s is %s (cached)" % (cc, tc['version']))
+        g['_toolchain'] = tc
+        return tc
+
+    tc = {'id': id,
+          'cc': cc,
+          'ld': ld,
+          'cc_path': _which(cc),
+          'ld_path': _which(ld),
+          'version': '',
+          'flags': {} }
+    tc['cc_mtime'] = _mtime_or_none(tc['cc_path'])
+    tc['ld_mtime'] = _mtime_or_none(tc['ld_path'])
+    g['_toolchain'] = tc
+
+    # a missing compiler is not cached, so installing it is noticed
+    if tc['cc_path'] == None:
+        return tc
+
+    tc['version'] = _probe_cc_version(tc)
+    _message(1, "use(): %s is %s" % (cc, tc['version']))
+
+    with _toolchain_cache['lock']:
+        _toolchain_cache['entries'][key] = tc
+    _save_toolchain_cache()
+    return tc
+
+def _probe_cc_version(tc):
+    import subprocess
+    if tc['id'][:4] == 'msvc':
+        # cl prints its banner to stderr when run without arguments
+        probe = tc['cc']
+    else:
+        probe = tc['cc'] + ' --version'
+
+    try:
+        proc = subprocess.run(probe, shell=True,
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    except OSError:
+        return ''
+
+    out = proc.stdout + b'\n' + proc.stderr
+    for line in out.decode('utf-8', errors='replace').splitlines():
+        if line.strip() != '':
+            return line.strip()
+    return ''
+
+def _cc_supports(flag, link=False):
+    """true if the compiler from the last use() accepts flag, compiling
+    and, if link is set, linking a trivial program.  On msvc a link flag
+    is passed to the linker.  The answer is cached with the toolchain."""
+    import subprocess
+    import tempfile
+    tc = _ns()['_toolchain']
+    if tc.get('cc_path') == None:
+        return False
+
+    flag_key = ('link ' if link else 'cc ') + flag
+    if flag_key in tc['flags']:
+        return tc['flags'][flag_key]
+
+    with tempfile.TemporaryDirectory(prefix='jfdi') as tmp_dir:
+        src = os.path.join(tmp_dir, 'probe.c')
+        with open(src, 'w') as f:
+            f.write('int main(void) { return 0; }\n')
+
+        if tc['id'][:4] == 'msvc' and link:
+            # a linker option, passed through to link.exe
+            out = os.path.join(tmp_dir, 'probe.exe')
+            probe = '%s /nologo %s /Fe%s /link %s' % (tc['cc'], src, out, flag)
+        elif tc['id'][:4] == 'msvc':
+            out = os.path.join(tmp_dir, 'probe.obj')
+            probe = '%s /nologo %s /c %s /Fo%s' % (tc['cc'], flag, src, out)
+        else:
+            out = os.path.join(tmp_dir, 'probe' if link else 'probe.o')
+            # -Werror catches clang's "argument unused" for flags it ignores
+            probe = '%s %s -Werror %s %s -o %s' % \
+                    (tc['cc'], flag, '' if link else '-c', src, out)
+
+        proc = subprocess.run(probe, shell=True, cwd=tmp_dir,
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+
+    # msvc only warns about options it does not know (D9002, LNK4044)
+    supported = proc.returncode == 0 and b'D9002' not in proc.stdout and \
+        b'LNK4044' not in proc.stdout
+    _message(1, "use(): %s %s %s" %
+             (tc['cc'], 'accepts' if supported else 'rejects', flag))
+
+    with _toolchain_cache['lock']:
+        tc['flags'][flag_key] = supported
+    _save_toolchain_cache()
+    return supported
+
 def _api_arg(flag):
-    if 'CCTYPE' not in globals():
+    if 'CCTYPE' not in _ns():
         _fatal_error("must call use() before arg()")
 
     i = 0
     if flag[0] == '-' or flag[0] == '/':
         i = 1
 
-    if globals()['CCTYPE'] == 'msvc':
+    if _ns()['CCTYPE'] == 'msvc':
         symbol = '/'
     else:
         symbol = '-'
@@ -803,49 +3893,194 @@ def _api_arg(flag):
     return symbol + flag[i:]
 
 
+#
+# precompiled headers
+#
+# pch() registers a header to compile into .jfdi/pch/<config>/, where
+# <config> hashes the compiler, flags, header and variant, so switching
+# between configurations does not rebuild it.  It then adds the flags
+# that use it to CFLAGS or CXXFLAGS.  The header is compiled with the
+# flags the script ends up with, less those, so flags added after pch()
+# apply to it as they do to the files that use it.
+#
+# The pch job tracks the headers it includes like any compile.  Compile
+# jobs whose command contains the use flags wait in the job pool for the
+# pch job, and list the pch as an input.  gcc's depfile does not mention
+# the headers a pch pulled in, so when the pch is rebuilt every job that
+# uses it is rebuilt too.
+#
+_pch = {'entries': {} }  # (header path, cxx) -> entry dict
+
+def _api_pch(header, cxx=False):
+    g = _ns()
+    if 'CCTYPE' not in g:
+        _fatal_error("must call use() before pch()\n")
+
+    flags_var = 'CXXFLAGS' if cxx else 'CFLAGS'
+    cc = g['CXX' if cxx else 'CC']
+    header_path = os.path.abspath(header)
+    name = os.path.basename(header)
+
+    # called again with the flags it already added, eg. from clean()
+    entry = g['_pch']['entries'].get((header_path, cxx))
+    if entry != None and \
+       all(f in g[flags_var] for f in entry['use_flags']):
+        return list(entry['link'])
+
+    flags = ' '.join(g[flags_var])
+    config = _hash_str('\0'.join((cc, flags, header_path,
+                                   str(g['_variant'])))).hex()[:12]
+    out_dir = os.path.join(_cfg['state_dir'], 'pch', config)
+    os.makedirs(out_dir, exist_ok=True)
+
+    if g['CCTYPE'] == 'msvc':
+        # /Yc compiles a source file, stopping after the header
+        stub = os.path.join(out_dir, name + ('.cpp' if cxx else '.c'))
+        pch_path = os.path.join(out_dir, name + '.pch')
+        obj_path = os.path.join(out_dir, name + '.obj')
+        _write_if_changed(stub, '#include "%s"\n' % name)
+        include = '/I' + os.path.dirname(header_path)
+        args = '%s /c /Yc%s /Fp%s /Fo%s %s' % \
+               (include, name, pch_path, obj_path, stub)
+        outputs = [pch_path, obj_path]
+        use_flags = [include, '/FI' + name, '/Yu' + name, '/Fp' + pch_path]
+        link = [obj_path]
+        match = pch_path
+
+    elif g['_toolchain'].get('id') == 'clang' or \
+         'clang' in os.path.basename(cc.split(' ')[0]):
+        pch_path = os.path.join(out_dir, name + '.pch')
+        args = '-x %s %s -o %s' % \
+               ('c++-header' if cxx else 'c-header', header_path, pch_path)
+        outputs = [pch_path]
+        use_flags = ['-include-pch', pch_path]
+        link = []
+        match = pch_path
+
+    else:
+        # gcc uses stub.gch in place of a stub that includes the real
+        # header.  the stub keeps -E, and so the object cache, working.
+        stub = os.path.join(out_dir, name)
+        pch_path = stub + '.gch'
+        _write_if_changed(stub, '#include "%s"\n' % header_path)
+        args = '-x %s %s -o %s' % \
+               ('c++-header' if cxx else 'c-header', stub, pch_path)
+        outputs = [pch_path]
+        use_flags = ['-include', stub]
+        link = []
+        match = stub
+
+    _message(1, "pch %s: %s" % (header, ' '.join(use_flags)))
+    g['_pch']['entries'][(header_path, cxx)] = {'job': None,
+                                                'header': header,
+                                                'cc': cc,
+                                                'flags_var': flags_var,
+                                                'args': args,
+                                                'outputs': outputs,
+                                                'match': match,
+                                                'pch': pch_path,
+                                                'use_flags': use_flags,
+                                                'link': link}
+    g[flags_var] = g[flags_var] + use_flags
+    return list(link)
+
+def _pch_job(g, entry):
+    """make the job that compiles a pch() header with the flags of
+    namespace g as they are now, less those that use a pch"""
+    flags = list(g[entry['flags_var']])
+    for e in g['_pch']['entries'].values():
+        n = len(e['use_flags'])
+        for i in range(len(flags) - n, -1, -1):
+            if flags[i:i + n] == e['use_flags']:
+                del flags[i:i + n]
+
+    cmd = '%s %s %s' % (entry['cc'], ' '.join(flags), entry['args'])
+    job = _Job(cmd, [entry['header']], list(entry['outputs']),
+               deps=g['CCTYPE'])
+    job.source = entry['header']
+    _add_dep_flags(job)
+    entry['job'] = job
+    return job
+
+def _write_if_changed(path, text):
+    """write text to path unless it already holds it, keeping the mtime
+    of an unchanged file"""
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return
+    except OSError:
+        pass
+    with open(path, 'w') as f:
+        f.write(text)
+
+def _add_pch_after(job):
+    """make job wait for the pch() jobs its command uses"""
+    for entry in _ns()['_pch']['entries'].values():
+        if entry['match'] in job.cmd and entry['job'] not in job.after:
+            job.after.append(entry['job'])
+            job.inputs.append(entry['pch'])
+
+def _wait_for_pch(cmd_str):
+    """block a cmd() that uses a pch() until it has been built"""
+    if _active_pool == None:
+        return
+    for entry in _ns()['_pch']['entries'].values():
+        if entry['match'] in cmd_str and entry['job'] != None:
+            _active_pool.wait_for(entry['job'])
+
 def _api_obj(path, in_prefix_path=''):
     prefix_path = _swap_slashes(in_prefix_path)
-    if 'CCTYPE' not in globals():
+    if 'CCTYPE' not in _ns():
         _fatal_error('you must call use() before calling obj()\n')
 
     in_paths = _str_to_list(path)
     out_paths = []
     
     ext = ''
-    if globals()['CCTYPE'] == 'msvc':
+    if _ns()['CCTYPE'] == 'msvc':
         ext = '.obj'
-    elif globals()['CCTYPE'] == 'gcc':
+    elif _ns()['CCTYPE'] == 'gcc':
         ext = '.o'
 
     for p in in_paths:
+        # a file built as part of a unity source shares its object, which
+        # goes where obj() would put an input file at the top level
+        if len(_unity['sources']) != 0:
+            p = _unity['members'].get(os.path.normpath(p), p)
+            if p in _unity['sources']:
+                p = os.path.basename(p)
+
         split = os.path.splitext(p)
 
         filename = split[0] + ext
         path = os.path.join(prefix_path, filename)
-        
+
+        if len(_unity['sources']) != 0 and path in out_paths:
+            continue
         out_paths.append(path)
 
     return _list_single_to_str(out_paths)
     
 
 def _api_var(key):
-    global _cfg
+    build_vars = _build_vars()
 
     ukey = key.upper()
-    if ukey not in _cfg['build_vars']:
+    if ukey not in build_vars:
         return ''
         
-    return _cfg['build_vars'][ukey]
+    return build_vars[ukey]
 
 
 def _api_yes(key):
-    global _cfg
+    build_vars = _build_vars()
     
     ukey = key.upper()
-    if ukey not in _cfg['build_vars']:
+    if ukey not in build_vars:
         return False
 
-    if _cfg['build_vars'][ukey] == '0':
+    if build_vars[ukey] == '0':
         return False
     
     # it is not possible to have a build var with a len(0) value so it
@@ -857,7 +4092,7 @@ def _api_exe(path, append_if_debug=None):
     split = os.path.splitext(path)
 
     exe = ''
-    if globals()['TARGET_OS'] == 'Windows':
+    if _ns()['TARGET_OS'] == 'Windows':
         exe = '.exe'
 
     base_str = str(split[0])
@@ -870,9 +4105,9 @@ def _api_dll(path, append_if_debug=None):
     split = os.path.splitext(path)
 
     dll = '.so'
-    if globals()['TARGET_OS'] == 'Windows':
+    if _ns()['TARGET_OS'] == 'Windows':
         dll = '.dll'
-    elif globals()['TARGET_OS'] == 'Darwin':
+    elif _ns()['TARGET_OS'] == 'Darwin':
         dll = '.dylib'
 
     base_str = str(split[0])
@@ -913,16 +4148,16 @@ def _api_exp(in_str):
                     val = frame.f_locals[var]
                     
                 # scan vars second (command line override)                
-                elif var in _cfg['build_vars']:
+                elif var in _build_vars():
                     
-                    val = _cfg['build_vars'][var]
+                    val = _build_vars()[var]
                 # check environment variables, third
                 elif var in os.environ:
                     val = os.environ[var]
                     
                 # fall back to global vars
-                elif var in globals():
-                    val = globals()[var]
+                elif var in _ns():
+                    val = _ns()[var]
                 else:
                     _fatal_error("exp(): var %s not found.\n" % var)
                     
@@ -943,12 +4178,274 @@ def _api_pth(path):
 # main
 #
 
-if __name__ == '__main__':
+#
+# jfdi server
+#
+# The server loads the build script and jfdi's state files once, and
+# forks a child to handle each request, so every build starts warm but
+# with its own globals and build vars.  Before forking, state files that
+# a previous build rewrote are reloaded and a changed build script is
+# recompiled.
+#
+# A client connects to .jfdi/server.sock next to the build script and
+# sends its stdin, stdout and stderr along with argv, cwd and the
+# environment.  The child writes to the client's terminal directly and
+# sends back its exit code.  If the client goes away, eg. on ctrl-c, the
+# child and its commands are killed.
+#
+def _server_socket_path(argv):
+    """path of the socket serving the build script argv refers to"""
+    script_path = 'build.jfdi'
+    for i, arg in enumerate(argv[:-1]):
+        if arg in ('-f', '--file'):
+            script_path = argv[i + 1]
+    for arg in argv:
+        if arg.startswith('--file='):
+            script_path = arg[len('--file='):]
+    return os.path.join(os.path.dirname(script_path), '.jfdi', 'server.sock')
+
+def _server_client(argv):
+    """have a running jfdi server handle argv.  returns its exit code, or
+    None if there is no server to ask"""
+    if os.environ.get('JFDI_NO_SERVER') or len(argv) != 0 and \
+       argv[0] in ('server', 'init', 'help'):
+        return None
+
+    sock_path = _server_socket_path(argv)
+    if not os.path.exists(sock_path):
+        return None
+
+    import socket
+    if not hasattr(socket, 'send_fds'):
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sock_path)
+    except OSError:
+        # stale socket from a server that is gone
+        return None
+
+    request = marshal.dumps({'argv': [sys.argv[0]] + argv,
+                             'cwd': os.getcwd(),
+                             'env': dict(os.environ)})
+    try:
+        socket.send_fds(conn, [len(request).to_bytes(4, 'big')], [0, 1, 2])
+        conn.sendall(request)
+
+        status = b''
+        while len(status) < 4:
+            chunk = conn.recv(4 - len(status))
+            if len(chunk) == 0:
+                _fatal_error("jfdi server closed the connection\n")
+            status += chunk
+    except KeyboardInterrupt:
+        # closing the connection makes the server kill the build
+        return 130
+    finally:
+        conn.close()
+
+    return int.from_bytes(status, 'big', signed=True)
+
+def _serve(args):
+    import selectors
+    import socket
+    if not hasattr(os, 'fork') or not hasattr(socket, 'send_fds'):
+        _fatal_error("jfdi server needs fork() and a Unix domain socket\n")
+
+    # everything a build might import is imported once, up front
+    import argparse, subprocess, shutil, hashlib, threading
+    import concurrent.futures
+
+    _get_script(args.file)
+    sock_path = os.path.join(_cfg['state_dir'], 'server.sock')
+    os.makedirs(_cfg['state_dir'], exist_ok=True)
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(16)
+    _message(0, "serving %s on %s" % (args.file, sock_path))
+
+    sel = selectors.DefaultSelector()
+    sel.register(server, selectors.EVENT_READ)
+    children = {}  # connection -> child pid
+    try:
+        while True:
+            for key, _ in sel.select(1.0):
+                if key.fileobj is server:
+                    conn, _ = server.accept()
+                    pid = _serve_request(conn, server, args)
+                    if pid == None:
+                        conn.close()
+                        continue
+                    children[conn] = pid
+                    sel.register(conn, selectors.EVENT_READ)
+                    continue
+
+                # clients send nothing more, so this is a disconnect
+                conn = key.fileobj
+                pid = children.pop(conn)
+                sel.unregister(conn)
+                conn.close()
+                try:
+                    os.killpg(pid, 15)
+                except OSError:
+                    pass
+
+            # reap finished children
+            while len(children) != 0:
+                try:
+                    pid, _ = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+
+    except KeyboardInterrupt:
+        _message(0, "server stopped")
+    finally:
+        server.close()
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+
+def _serve_request(conn, server, args):
+    """fork a child to run the request on conn.  returns its pid"""
+    import socket
+    try:
+        head, fds, _, _ = socket.recv_fds(conn, 4, 3)
+        size = int.from_bytes(head, 'big')
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if len(chunk) == 0:
+                raise OSError("client went away")
+            data += chunk
+        request = marshal.loads(data)
+    except (OSError, EOFError, ValueError) as e:
+        _message(1, "bad request: %s" % e)
+        return None
+
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    _serve_refresh(args.file)
+
+    pid = os.fork()
+    if pid != 0:
+        for fd in fds:
+            os.close(fd)
+        _message(1, "%s: %s" % (pid, ' '.join(request['argv'][1:])))
+        return pid
+
+    # child: become the client, then run jfdi as if it was started there
+    global g_start_time, g_start_perf
+    exit_code = 1
+    try:
+        server.close()
+        os.setsid()
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+        # paths in the warm caches are relative to the server's cwd
+        if request['cwd'] != os.getcwd():
+            for _, cache, _, empty in _serve_caches():
+                cache.update(empty)
+                cache['loaded'] = False
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = request['argv']
+        g_start_time = time.time()
+        g_start_perf = time.perf_counter()
+        _main()
+    except SystemExit as e:
+        if e.code == None:
+            exit_code = 0
+        elif e.code.__class__ == int:
+            exit_code = e.code
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            # os._exit() skips the atexit hook that writes --trace
+            if _trace['events'] != None:
+                _write_trace()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(exit_code.to_bytes(4, 'big', signed=True))
+        finally:
+            os._exit(0)
+
+# state files, and the caches to reload when a build rewrites them
+_serve_state = {}  # path -> (mtime_ns, size) when last loaded
+
+def _serve_refresh(script_path):
+    """reload whatever changed on disk since the last request"""
+    # a syntax error is left for the child to report
+    try:
+        _get_script(script_path)
+    except SystemExit:
+        pass
+
+    for path, cache, load, empty in _serve_caches():
+        try:
+            st = os.stat(path)
+            state = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            state = None
+        if _serve_state.get(path, 0) == state:
+            continue
+
+        _serve_state[path] = state
+        cache.update(empty)
+        cache['loaded'] = False
+        load()
+
+def _serve_caches():
+    return ((_build_log_path(), _build_log, _load_build_log,
+             {'outputs': {}, 'files': {}, 'durations': {}, 'seen': {}}),
+            (_deps_path(), _deps, _load_deps,
+             {'paths': [], 'ids': None, 'outputs': {}}),
+            (_toolchain_cache_path(), _toolchain_cache,
+             _load_toolchain_cache, {'entries': {}}),
+            (_dir_cache_path(), _dir_cache, _load_dir_cache,
+             {'dirs': {}}))
+
+def _fast_dispatch(argv):
+    """handle invocations that need neither argparse nor a build script.
+    Returns False if argv should go through _ArgDispatch instead."""
+    if argv == ['--version'] or argv == ['build', '--version']:
+        print(_pp_version())
+        return True
+
+    if len(argv) == 2 and argv[0] == 'help' and argv[1][0] != '-':
+        _display_help_topic(argv[1])
+        return True
+
+    if argv == ['init'] or \
+       (len(argv) == 3 and argv[0] == 'init' and argv[1] in ('-f', '--file')):
+        path = 'build.jfdi' if len(argv) == 1 else argv[2]
+        generate_tmpl(path)
+        _report_success(g_start_time)
+        return True
+
+    return False
+
+def _main():
+    """run jfdi with the arguments in sys.argv.  exits"""
 
     dispatch = _ArgDispatch()
     subcommand, args, build_vars = dispatch.dispatch()
 
-
     #
     # subcommand init
     #
@@ -972,8 +4469,29 @@ if __name__ == '__main__':
         print(_pp_version())
         sys.exit(0)
         
+    if subcommand == 'server':
+        _serve(args)
+        sys.exit(0)
+
+    # builds share -j with make, as a jobserver client or server
+    _jobserver_init(subcommand in ('build', 'watch'))
+
     # all subcommands not handled yet require execution of the build script.
     pycode = _get_script(args.file)
+
+    if getattr(args, 'variants', None) != None:
+        #
+        # build or clean with --variants
+        #
+        variants = _ArgDispatch._parse_variants(args.variants, build_vars,
+                                                args.target_os)
+        if subcommand == 'clean':
+            _clean_variants(pycode, variants)
+        else:
+            _build_variants(pycode, variants, args.run)
+        _report_success(g_start_time)
+        sys.exit(0)
+
     context = _run_script(pycode, args.target_os)
 
     if subcommand == 'clean':
@@ -988,6 +4506,12 @@ if __name__ == '__main__':
         #
         _canonical_run(context, args.target_os)
 
+    elif subcommand == 'watch':
+        #
+        # subcommand watch
+        #
+        _watch(context, args.target_os, args)
+
     else:
         #
         # subcommand build (default)
@@ -999,3 +4523,13 @@ if __name__ == '__main__':
     _report_success(g_start_time)
     sys.exit(0)
 
+if __name__ == '__main__':
+
+    if _fast_dispatch(sys.argv[1:]):
+        sys.exit(0)
+
+    exit_code = _server_client(sys.argv[1:])
+    if exit_code != None:
+        sys.exit(exit_code)
+
+    _main()
@@ -0,0 +1,42 @@
+# helpers for tests that build a small project with a nested jfdi and
+# check which commands it ran.  tests import this with
+#
+#   sys.path.insert(0, '..')
+#   import nested
+
+import os
+import re
+import subprocess
+import sys
+
+JFDI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'jfdi.py')
+
+def write(path, text):
+    """write text to path, making its directory"""
+    if os.path.dirname(path) != '':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def build(proj, args='', subcommand='build'):
+    """build proj/build.jfdi, or run another subcommand on it, returning
+    the commands it ran.  exits like die() if it failed"""
+    proc = subprocess.run('%s %s %s -f %s %s' %
+                          (sys.executable, JFDI, subcommand,
+                           os.path.join(proj, 'build.jfdi'), args),
+                          shell=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stdout)
+        sys.stderr.write("die: nested build of %s failed\n" % proj)
+        sys.exit(3)
+
+    # '[  12 ms] cmd', or '[  12 ms] [DEBUG=1] cmd' with --variants
+    return re.findall(r'^\[ *\d+ ms\] (?:\[[^\]]*\] )?(.*)$', proc.stdout,
+                      re.MULTILINE)
+
+def compiled(cmds):
+    """the files that cmds compiled with -c, sorted"""
+    return sorted(m.group(1) for m in (re.search(r' -c (\S+)', c)
+                                       for c in cmds) if m != None)